@@ -1,3 +1,5 @@
 from .models import *
 from .base import *
-from .loader import *
\ No newline at end of file
+from .loader import *
+from .cache import *
+from .filters import *
@@ -1,14 +1,21 @@
 from abc import abstractmethod, ABC
-from typing import Any, List
+from typing import Any, Iterable, Optional
 
 from .models import Task
 
 
 class AnnotationLoader(ABC):
     @abstractmethod
-    def get_tasks(self, path: Any) -> List[Task]:
+    def get_tasks(self, path: Any) -> Iterable[Task]:
         pass
 
+    def get_fingerprint(self, path: Any) -> Optional[str]:
+        """
+        Cheap identifier of the current contents at `path`, changes whenever they do.
+        None if the loader can't tell, then its annotations are never cached.
+        """
+        return None
+
 
 __all__ = [
     'AnnotationLoader'
@@ -0,0 +1,281 @@
+import os
+import json
+import math
+import mmap
+import hashlib
+import tempfile
+import warnings
+from itertools import pairwise
+from pathlib import Path
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from .base import AnnotationLoader
+from .models import Task, Annotation, Region, Choices
+
+
+MAGIC = b'AEANNOT1'
+# Bump when the layout or the models change, older files are rebuilt then
+FORMAT_VERSION = 1
+ALIGNMENT = 64
+
+REGION, CHOICES = 0, 1
+
+
+def source_fingerprint(sources: Iterable[Tuple[AnnotationLoader, Any]]) -> Optional[str]:
+    """
+    Combined fingerprint of annotation sources, None if one of them can't be fingerprinted.
+    """
+    digest = hashlib.sha256(str(FORMAT_VERSION).encode('utf-8'))
+    for loader, path in sources:
+        fingerprint = loader.get_fingerprint(path)
+        if fingerprint is None:
+            return None
+        digest.update(json.dumps([type(loader).__name__, str(path), fingerprint]).encode('utf-8'))
+    return digest.hexdigest()
+
+
+class AnnotationCache:
+    """
+    Parsed tasks stored in a columnar binary file, so later runs skip JSON parsing.
+
+    The file is a JSON header followed by flat little-endian arrays: one row per
+    task, annotation and annotation data item, with offset arrays linking them,
+    all region points in one (N, 2) array and every string in a deduplicated
+    table. It is loaded with mmap and region points are views into it.
+
+    A file is only used if it was written for the same `source` fingerprint.
+    """
+    def __init__(self, path: str | Path):
+        self.path = Path(path)
+
+    def load(self, source: str) -> Optional[List[Task]]:
+        try:
+            with open(self.path, 'rb') as file:
+                memory = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (FileNotFoundError, ValueError):
+            return None
+
+        try:
+            if memory[:len(MAGIC)] != MAGIC:
+                return None
+            header_end = len(MAGIC) + 8 + int.from_bytes(memory[len(MAGIC):len(MAGIC) + 8], 'little')
+            header = json.loads(memory[len(MAGIC) + 8:header_end])
+            if header['version'] != FORMAT_VERSION or header['source'] != source:
+                return None
+
+            # Column offsets are relative to the aligned end of the header
+            start = _aligned(header_end)
+            columns = {
+                name: np.frombuffer(
+                    memory,
+                    dtype=np.dtype(dtype),
+                    count=int(np.prod(shape)),
+                    offset=start + offset
+                ).reshape(shape)
+                for name, (dtype, shape, offset) in header['columns'].items()
+            }
+        except (ValueError, KeyError):
+            return None
+        return _decode(columns)
+
+    def save(self, source: str, tasks: Iterable[Task]):
+        columns = _encode(tasks)
+
+        header, offset = {}, 0
+        for name, column in columns.items():
+            header[name] = (column.dtype.str, column.shape, offset)
+            offset += _aligned(column.nbytes)
+        header = json.dumps({
+            'version': FORMAT_VERSION,
+            'source': source,
+            'columns': header
+        }).encode('utf-8')
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=self.path.parent, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as file:
+                file.write(MAGIC)
+                file.write(len(header).to_bytes(8, 'little'))
+                file.write(header)
+                for column in columns.values():
+                    file.write(b'\0' * (_aligned(file.tell()) - file.tell()))
+                    file.write(column.tobytes())
+            os.replace(temp_path, self.path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+
+    def write_through(self, source: str, tasks: Iterable[Task]) -> Iterator[Task]:
+        """
+        Yields `tasks` and saves them once all of them were consumed.
+        """
+        collected = []
+        for task in tasks:
+            collected.append(task)
+            yield task
+
+        try:
+            self.save(source, collected)
+        except TypeError as e:
+            warnings.warn(f"Annotations were not cached: {e}", RuntimeWarning)
+
+
+def _aligned(size: int) -> int:
+    return (size + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def _encode(tasks: Iterable[Task]) -> Dict[str, np.ndarray]:
+    strings: Dict[str, int] = {}
+
+    def string(value: Optional[str]) -> int:
+        if value is None:
+            return -1
+        return strings.setdefault(value, len(strings))
+
+    def identifier(value) -> Tuple[int, int]:
+        # Task and annotation ids are numbers in Label Studio, result ids are strings
+        if isinstance(value, int) and not isinstance(value, bool):
+            return value, -1
+        return 0, string(str(value))
+
+    task_ids, task_urls, task_annotations = [], [], [0]
+    annotation_ids, annotation_updated_at, annotation_rotations, annotation_data = [], [], [], [0]
+    data_kinds, data_ids, data_fields, data_rotations = [], [], [], []
+    data_strings, string_refs = [0], []
+    data_points, points = [0], []
+
+    for task in tasks:
+        task_ids.append(identifier(task.id))
+        task_urls.append(string(task.image_url))
+
+        for annotation in task.annotations:
+            annotation_ids.append(identifier(annotation.id))
+            annotation_updated_at.append(string(annotation.updated_at))
+            annotation_rotations.append(annotation.image_rotation)
+
+            for item in annotation.data.values():
+                data_ids.append(identifier(item.id))
+                if isinstance(item, Region):
+                    data_kinds.append(REGION)
+                    data_fields.append((
+                        string(getattr(item, 'type', None)),
+                        string(getattr(item, 'text', None)),
+                        getattr(item, 'original_width', -1),
+                        getattr(item, 'original_height', -1)
+                    ))
+                    rotation = getattr(item, 'image_rotation', None)
+                    data_rotations.append(np.nan if rotation is None else rotation)
+                    string_refs.extend(string(label) for label in item.labels)
+                    points.append(item.points)
+                    data_points.append(data_points[-1] + len(item.points))
+                elif isinstance(item, Choices):
+                    data_kinds.append(CHOICES)
+                    data_fields.append((-1, -1, -1, -1))
+                    data_rotations.append(np.nan)
+                    string_refs.extend(string(choice) for choice in item.choices)
+                    data_points.append(data_points[-1])
+                else:
+                    raise TypeError(f"Can't cache annotation data of type {type(item).__name__}")
+                data_strings.append(len(string_refs))
+            annotation_data.append(len(data_kinds))
+        task_annotations.append(len(annotation_ids))
+
+    text = ''.join(strings)
+    string_offsets = np.cumsum([0] + [len(s) for s in strings])
+
+    def column(values, dtype: str, width: int = 0) -> np.ndarray:
+        array = np.array(values, dtype=dtype)
+        return array.reshape((-1, width)) if width else array
+
+    return {
+        'strings': np.frombuffer(text.encode('utf-8'), dtype='u1'),
+        'string_offsets': column(string_offsets, '<i8'),
+        'task_ids': column(task_ids, '<i8', 2),
+        'task_urls': column(task_urls, '<i8'),
+        'task_annotations': column(task_annotations, '<i8'),
+        'annotation_ids': column(annotation_ids, '<i8', 2),
+        'annotation_updated_at': column(annotation_updated_at, '<i8'),
+        'annotation_rotations': column(annotation_rotations, '<f8'),
+        'annotation_data': column(annotation_data, '<i8'),
+        'data_kinds': column(data_kinds, 'u1'),
+        'data_ids': column(data_ids, '<i8', 2),
+        'data_fields': column(data_fields, '<i8', 4),
+        'data_rotations': column(data_rotations, '<f8'),
+        'data_strings': column(data_strings, '<i8'),
+        'string_refs': column(string_refs, '<i8'),
+        'data_points': column(data_points, '<i8'),
+        'points': np.concatenate(points).astype('<f8') if points else np.empty((0, 2), dtype='<f8')
+    }
+
+
+def _decode(columns: Dict[str, np.ndarray]) -> List[Task]:
+    text = columns['strings'].tobytes().decode('utf-8')
+    strings: List[Optional[str]] = [text[a:b] for a, b in pairwise(columns['string_offsets'].tolist())]
+    # Missing strings are stored as -1, which now picks this None
+    strings.append(None)
+
+    def identifier(value: int, ref: int):
+        return value if ref < 0 else strings[ref]
+
+    # Python lists index a lot faster than numpy arrays
+    task_urls = columns['task_urls'].tolist()
+    task_annotations = columns['task_annotations'].tolist()
+    annotation_ids = columns['annotation_ids'].tolist()
+    annotation_updated_at = columns['annotation_updated_at'].tolist()
+    annotation_rotations = columns['annotation_rotations'].tolist()
+    annotation_data = columns['annotation_data'].tolist()
+    data_kinds = columns['data_kinds'].tolist()
+    data_ids = columns['data_ids'].tolist()
+    data_fields = columns['data_fields'].tolist()
+    data_rotations = columns['data_rotations'].tolist()
+    data_strings = columns['data_strings'].tolist()
+    string_refs = columns['string_refs'].tolist()
+    data_points = columns['data_points'].tolist()
+    points = columns['points']
+
+    tasks = []
+    for t, (task_id, task_ref) in enumerate(columns['task_ids'].tolist()):
+        task = Task(identifier(task_id, task_ref))
+        task.image_url = strings[task_urls[t]]
+
+        for a in range(task_annotations[t], task_annotations[t + 1]):
+            annotation = Annotation(
+                id=identifier(*annotation_ids[a]),
+                image_rotation=annotation_rotations[a],
+                updated_at=strings[annotation_updated_at[a]]
+            )
+
+            items = {}
+            for d in range(annotation_data[a], annotation_data[a + 1]):
+                values = [strings[i] for i in string_refs[data_strings[d]:data_strings[d + 1]]]
+                if data_kinds[d] == CHOICES:
+                    item = Choices(id=identifier(*data_ids[d]), choices=values)
+                else:
+                    item = Region(id=identifier(*data_ids[d]))
+                    region_type, region_text, width, height = data_fields[d]
+                    if region_type >= 0:
+                        item.type = strings[region_type]
+                    if region_text >= 0:
+                        item.text = strings[region_text]
+                    if width >= 0:
+                        item.original_width = width
+                    if height >= 0:
+                        item.original_height = height
+                    if not math.isnan(data_rotations[d]):
+                        item.image_rotation = data_rotations[d]
+                    item.labels = values
+                    item.points = points[data_points[d]:data_points[d + 1]]
+                items[item.id] = item
+            annotation.data.update(items)
+            task.annotations.append(annotation)
+        tasks.append(task)
+    return tasks
+
+
+__all__ = [
+    'AnnotationCache',
+    'source_fingerprint'
+]
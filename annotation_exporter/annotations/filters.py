@@ -0,0 +1,171 @@
+import hashlib
+import dataclasses
+from datetime import datetime, timezone
+from typing import Any, FrozenSet, Iterable, Optional
+
+from .models import Annotation, Task
+
+
+def _parse_datetime(value: str) -> datetime:
+    # fromisoformat only takes Label Studio's trailing Z from Python 3.11 on
+    if value.endswith(('Z', 'z')):
+        value = value[:-1] + '+00:00'
+    parsed = datetime.fromisoformat(value)
+    # Label Studio timestamps are UTC
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed
+
+
+def _hash_id(salt: str, task_id: Any) -> int:
+    digest = hashlib.sha256(f"{salt}:{task_id}".encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big')
+
+
+@dataclasses.dataclass(frozen=True)
+class Shard:
+    """
+    Slice `index` of `count` of the tasks, numbered from 1. Tasks are assigned
+    by a hash of their id, so separate runs split the same tasks the same way
+    and every task lands in exactly one shard.
+    """
+    index: int
+    count: int
+
+    def __post_init__(self):
+        if not 1 <= self.index <= self.count:
+            raise ValueError(f"Shard {self.index}/{self.count} is not between 1/{self.count} and {self.count}/{self.count}")
+
+    @classmethod
+    def parse(cls, value: str) -> "Shard":
+        index, separator, count = value.partition('/')
+        if not separator or not index.strip().isdigit() or not count.strip().isdigit():
+            raise ValueError(f"Shard {value!r} is not K/N")
+        return cls(int(index), int(count))
+
+    def keeps_task_id(self, task_id: Any) -> bool:
+        return _hash_id('shard', task_id) % self.count == self.index - 1
+
+    def file_name(self, path: str) -> str:
+        """This shard's version of a file every shard writes: `data.csv` is `data.2-of-4.csv`."""
+        head, dot, extension = path.rpartition('.')
+        if not dot or not head or head.endswith('/') or '/' in extension:
+            return f"{path}.{self.index}-of-{self.count}"
+        return f"{head}.{self.index}-of-{self.count}.{extension}"
+
+    def __str__(self) -> str:
+        return f"{self.index}/{self.count}"
+
+
+@dataclasses.dataclass(frozen=True)
+class TaskFilter:
+    """
+    Selects which tasks and annotations are exported. Loaders apply it while
+    loading, so annotations that can't match are dropped before any image is
+    downloaded, and S3 objects listed as older than `updated_since` aren't
+    downloaded at all.
+    """
+    # Keep annotations in one of these splits ("Training", "Validation")
+    splits: Optional[FrozenSet[str]] = None
+    # Keep these tasks only
+    task_ids: Optional[FrozenSet[str]] = None
+    # Keep annotations updated at or after this time
+    updated_since: Optional[datetime] = None
+    # Keep this fraction of tasks, picked by a hash of their id
+    sample: Optional[float] = None
+    seed: int = 0
+    # Keep the tasks of this shard only
+    shard: Optional[Shard] = None
+
+    @classmethod
+    def parse(
+        cls,
+        expressions: Iterable[str],
+        sample: Optional[float] = None,
+        seed: int = 0,
+        shard: Optional[Shard] = None
+    ) -> "TaskFilter":
+        """
+        Builds a filter from `key=value` expressions: `split=Validation`,
+        `task=12,15` and `since=2024-05-01`. Comma separated values match any of them.
+        """
+        options: dict[str, Any] = {}
+        for expression in expressions:
+            key, separator, value = expression.partition('=')
+            if not separator or not value:
+                raise ValueError(f"Filter {expression!r} is not key=value")
+            values = frozenset(v.strip() for v in value.split(','))
+            match key.strip():
+                case 'split':
+                    options['splits'] = options.get('splits', frozenset()) | values
+                case 'task':
+                    options['task_ids'] = options.get('task_ids', frozenset()) | values
+                case 'since':
+                    options['updated_since'] = _parse_datetime(value.strip())
+                case _:
+                    raise ValueError(f"Unknown filter {key!r}")
+
+        if sample is not None and not 0 < sample <= 1:
+            raise ValueError("Sample must be a fraction in (0, 1]")
+        return cls(**options, sample=sample, seed=seed, shard=shard)
+
+    @property
+    def filters_annotations(self) -> bool:
+        return self.splits is not None or self.updated_since is not None
+
+    def key(self) -> str:
+        """Stable description of the filter, part of cache fingerprints."""
+        key = repr((
+            sorted(self.splits) if self.splits is not None else None,
+            sorted(self.task_ids) if self.task_ids is not None else None,
+            self.updated_since.isoformat() if self.updated_since is not None else None,
+            self.sample,
+            self.seed
+        ))
+        if self.shard is not None:
+            key += f" shard {self.shard}"
+        return key
+
+    def keeps_object(self, last_modified: Optional[datetime]) -> bool:
+        """
+        Whether an S3 annotation object can match, judging by its listing alone.
+        Objects are written when an annotation is saved, so one last modified
+        before `updated_since` holds an older annotation.
+        """
+        return self.updated_since is None or last_modified is None or last_modified >= self.updated_since
+
+    def keeps_task_id(self, task_id: Any) -> bool:
+        task_id = str(task_id)
+        if self.task_ids is not None and task_id not in self.task_ids:
+            return False
+        if self.shard is not None and not self.shard.keeps_task_id(task_id):
+            return False
+        if self.sample is not None:
+            return _hash_id(self.seed, task_id) < self.sample * 2 ** 64
+        return True
+
+    def keeps_annotation(self, annotation: Annotation) -> bool:
+        if self.splits is not None and self.splits.isdisjoint(annotation.data_categories):
+            return False
+        if self.updated_since is not None:
+            if annotation.updated_at is None or _parse_datetime(annotation.updated_at) < self.updated_since:
+                return False
+        return True
+
+    def apply(self, task: Task) -> Optional[Task]:
+        """
+        The task with only the annotations that match, `None` if it's filtered out.
+        """
+        if not self.keeps_task_id(task.id):
+            return None
+        if self.filters_annotations:
+            task.annotations = [a for a in task.annotations if self.keeps_annotation(a)]
+            if not task.annotations:
+                return None
+        return task
+
+
+__all__ = [
+    'Shard',
+    'TaskFilter'
+]
@@ -1,39 +1,197 @@
 import json
-from typing import Dict
+import hashlib
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, Dict, Iterator, Optional, TextIO
 from pathlib import Path
 
 from .models import *
 from annotation_exporter.s3 import S3Url, S3Context
+from annotation_exporter.stats import stats
 
 from .base import AnnotationLoader
+from .filters import TaskFilter
 
 
 class S3AnnotationLoader(AnnotationLoader):
-    def __init__(self, s3: S3Context):
+    def __init__(self, s3: S3Context, workers: int = 1, task_filter: Optional[TaskFilter] = None):
         self.s3 = s3
+        self.workers = max(1, workers)
+        self.task_filter = task_filter
 
     def get_tasks(self, s3_url: str | S3Url):
         if isinstance(s3_url, str):
             s3_url = S3Url(s3_url)
 
+        if self.workers > 1:
+            return self._get_tasks_concurrent(s3_url)
+
         tasks: Dict[str, Task] = {}
-        bucket =  self.s3.resource.Bucket(s3_url.bucket)
-        for object_summary in bucket.objects.filter(Prefix=s3_url.prefix):
-            object = bucket.Object(object_summary.key)
-            data = self.s3.download_bytes(object)
-            data = json.loads(data)
+        for page in self._list_pages(s3_url):
+            for key in page:
+                data = json.loads(self.s3.get_object_bytes(s3_url.bucket, key))
+                annotation = Annotation.from_json(data)
+                if not self._keeps(data, annotation):
+                    continue
 
-            task_data = data['task']
-            if (task_id := task_data['id']) not in tasks:
-                tasks[task_id] = Task(id=task_data['id'])
-                tasks[task_id].image_url = task_data['data']['ocr']
-            tasks[task_id].annotations.append(Annotation.from_json(data))
+                task_data = data['task']
+                if (task_id := task_data['id']) not in tasks:
+                    tasks[task_id] = Task(id=task_data['id'])
+                    tasks[task_id].image_url = task_data['data']['ocr']
+                tasks[task_id].annotations.append(annotation)
+                stats.count('annotations.loaded')
         return tasks.values()
 
+    def get_fingerprint(self, s3_url: str | S3Url) -> str:
+        if isinstance(s3_url, str):
+            s3_url = S3Url(s3_url)
+
+        # Listing is a fraction of the cost of getting every object
+        digest = hashlib.sha256()
+        for page in self.s3.list_keys(s3_url.bucket, s3_url.prefix):
+            for entry in page:
+                digest.update(f"{entry['Key']}\0{entry['ETag']}\0".encode('utf-8'))
+        if self.task_filter is not None:
+            digest.update(self.task_filter.key().encode('utf-8'))
+        return digest.hexdigest()
+
+    def _list_pages(self, s3_url: S3Url) -> Iterator[list[str]]:
+        """
+        Keys under the prefix, a listing page at a time. Objects the filter
+        rules out by their listing are left out, and never downloaded.
+        """
+        for page in self.s3.list_keys(s3_url.bucket, s3_url.prefix):
+            keys = []
+            for entry in page:
+                if self.task_filter is not None and not self.task_filter.keeps_object(entry.get('LastModified')):
+                    stats.count('annotations.filtered')
+                    continue
+                keys.append(entry['Key'])
+            yield keys
+
+    def _keeps(self, data: dict, annotation: Annotation) -> bool:
+        if self.task_filter is None:
+            return True
+        if self.task_filter.keeps_task_id(data['task']['id']) and self.task_filter.keeps_annotation(annotation):
+            return True
+        stats.count('annotations.filtered')
+        return False
+
+    def _get_tasks_concurrent(self, s3_url: S3Url):
+        """
+        Lists the prefix page by page and feeds every key to a pool of GET workers,
+        so downloads start before the listing is over. Workers parse the JSON and
+        merge annotations into a shared dict; listing order is restored at the end
+        to keep task and annotation order the same as in the serial mode.
+        """
+        tasks: Dict[str, Task] = {}
+        positions: Dict[str, int] = {}
+        annotation_positions: Dict[int, int] = {}
+        lock = threading.Lock()
+
+        def load(position: int, key: str):
+            data = json.loads(self.s3.get_object_bytes(s3_url.bucket, key))
+            annotation = Annotation.from_json(data)
+            if not self._keeps(data, annotation):
+                return
+            stats.count('annotations.loaded')
+
+            task_data = data['task']
+            with lock:
+                if (task_id := task_data['id']) not in tasks:
+                    tasks[task_id] = Task(id=task_id)
+                    tasks[task_id].image_url = task_data['data']['ocr']
+                    positions[task_id] = position
+                positions[task_id] = min(positions[task_id], position)
+                tasks[task_id].annotations.append(annotation)
+                annotation_positions[id(annotation)] = position
+
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='s3-loader') as pool:
+            in_flight = set()
+            position = 0
+            for page in self._list_pages(s3_url):
+                for key in page:
+                    in_flight.add(pool.submit(load, position, key))
+                    position += 1
+
+                    # Keep memory bounded on huge prefixes
+                    if len(in_flight) >= 4 * self.workers:
+                        done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            future.result()
+            for future in in_flight:
+                future.result()
+
+        for task in tasks.values():
+            task.annotations.sort(key=lambda a: annotation_positions[id(a)])
+        return [tasks[task_id] for task_id in sorted(tasks, key=positions.__getitem__)]
+
+
+def iter_json_array(file: TextIO, chunk_size: int = 1 << 16) -> Iterator[Any]:
+    """
+    Incrementally parses a top-level JSON array, yielding one element at a time.
+    Only the element being decoded is kept in memory.
+    """
+    decoder = json.JSONDecoder()
+    buffer, position, eof = '', 0, False
+
+    def read_more(size: int) -> None:
+        nonlocal buffer, position, eof
+        chunk = file.read(size)
+        eof = not chunk
+        buffer = buffer[position:] + chunk
+        position = 0
+
+    def skip_whitespace() -> str:
+        nonlocal position
+        while True:
+            while position < len(buffer) and buffer[position].isspace():
+                position += 1
+            if position < len(buffer):
+                return buffer[position]
+            if eof:
+                raise ValueError("Unexpected end of JSON array")
+            read_more(chunk_size)
+
+    if skip_whitespace() != '[':
+        raise ValueError("Expected a JSON array")
+    position += 1
+    if skip_whitespace() == ']':
+        return
+
+    read_size = chunk_size
+    while True:
+        try:
+            element, end = decoder.raw_decode(buffer, position)
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            # Element spans past the buffer, grow reads so big elements stay linear
+            read_more(read_size)
+            read_size *= 2
+            continue
+        if not eof and (end == len(buffer) or buffer[end] not in ', \t\n\r]'):
+            # A number could still be cut in half, wait for the delimiter
+            read_more(read_size)
+            continue
+
+        yield element
+        position, read_size = end, chunk_size
+
+        match skip_whitespace():
+            case ',':
+                position += 1
+                skip_whitespace()
+            case ']':
+                return
+            case other:
+                raise ValueError(f"Unexpected {other!r} in JSON array")
+
 
 class ExportAnnotationLoader(AnnotationLoader):
-    def __init__(self):
-        pass
+    def __init__(self, stream: bool = False, task_filter: Optional[TaskFilter] = None):
+        self.stream = stream
+        self.task_filter = task_filter
 
     def get_tasks(self, filepath: str | Path):
         if isinstance(filepath, str):
@@ -42,21 +200,56 @@ class ExportAnnotationLoader(AnnotationLoader):
             raise ValueError("Path doesn't exist")
         if not filepath.is_file():
             raise ValueError("Path is not a file")
+
+        if self.stream:
+            return self._iter_tasks(filepath)
         
         tasks = []
         with open(filepath, mode='r', encoding='utf-8') as file:
             data = json.load(file)
 
             for task_data in data:
-                task = Task(task_data["id"])
-                task.image_url = task_data['data']['ocr']
-                for annotation in task_data['annotations']:
-                    task.annotations.append(Annotation.from_json(annotation))
-                tasks.append(task)
+                if (task := self._parse_task(task_data)) is not None:
+                    tasks.append(task)
         return tasks
 
+    def get_fingerprint(self, filepath: str | Path) -> str:
+        filepath = Path(filepath).resolve()
+        stat = filepath.stat()
+        fingerprint = f"{filepath}:{stat.st_size}:{stat.st_mtime_ns}"
+        if self.task_filter is not None:
+            fingerprint += f":{self.task_filter.key()}"
+        return fingerprint
+
+    def _iter_tasks(self, filepath: Path) -> Iterator[Task]:
+        with open(filepath, mode='r', encoding='utf-8') as file:
+            for task_data in iter_json_array(file):
+                if (task := self._parse_task(task_data)) is not None:
+                    yield task
+
+    def _parse_task(self, task_data: dict) -> Optional[Task]:
+        # Task ids are checked before any annotation is parsed
+        if self.task_filter is not None and not self.task_filter.keeps_task_id(task_data["id"]):
+            stats.count('annotations.filtered', len(task_data['annotations']))
+            return None
+
+        task = Task(task_data["id"])
+        task.image_url = task_data['data']['ocr']
+        for annotation in task_data['annotations']:
+            task.annotations.append(Annotation.from_json(annotation))
+
+        if self.task_filter is not None:
+            count = len(task.annotations)
+            task = self.task_filter.apply(task)
+            stats.count('annotations.filtered', count - (len(task.annotations) if task is not None else 0))
+            if task is None:
+                return None
+        stats.count('annotations.loaded', len(task.annotations))
+        return task
+
 
 __all__ = [
     "S3AnnotationLoader",
-    "ExportAnnotationLoader"
+    "ExportAnnotationLoader",
+    "iter_json_array"
 ]
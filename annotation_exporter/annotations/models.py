@@ -1,7 +1,10 @@
 import abc
 import warnings
 import dataclasses
-from statistics import mean
+from statistics import fmean
+from types import MappingProxyType
+
+import numpy as np
 
 
 # @dataclasses.dataclass
@@ -12,7 +15,28 @@ from statistics import mean
 #     to_name: str = dataclasses.field(init=False)
 
 
-@dataclasses.dataclass
+# Annotation data types, in the order they are matched against the part types of an id
+_data_types: list[type["AnnotationData"]] = []
+# Part types -> matching annotation data type, filled in as new combinations show up
+_data_type_cache: dict[frozenset[str], type["AnnotationData"] | None] = {}
+
+
+def register_data_type(cls: type["AnnotationData"]) -> type["AnnotationData"]:
+    _data_types.append(cls)
+    _data_type_cache.clear()
+    return cls
+
+
+def find_data_type(types: frozenset[str]) -> type["AnnotationData"] | None:
+    try:
+        return _data_type_cache[types]
+    except KeyError:
+        data_type = next((cls for cls in _data_types if cls.is_instance(types)), None)
+        _data_type_cache[types] = data_type
+        return data_type
+
+
+@dataclasses.dataclass(slots=True)
 class AnnotationData(abc.ABC):
     id: str
 
@@ -26,14 +50,17 @@ class AnnotationData(abc.ABC):
         pass 
 
 
-@dataclasses.dataclass
+@register_data_type
+@dataclasses.dataclass(slots=True)
 class Region(AnnotationData):
+    type: str = dataclasses.field(init=False)
     text: str = dataclasses.field(init=False)
     original_width: int = dataclasses.field(init=False)
     original_height: int = dataclasses.field(init=False)
     image_rotation: int | None = dataclasses.field(init=False)
     labels: list[str] = dataclasses.field(default_factory=list)
-    points: list[list[int, int]] = dataclasses.field(default_factory=list)
+    # (N, 2) array of x, y in percent of the image size, closed (last point is the first)
+    points: np.ndarray = dataclasses.field(default_factory=lambda: np.empty((0, 2)), compare=False)
 
     @staticmethod
     def is_instance(types: set[str]) -> bool:
@@ -58,18 +85,19 @@ class Region(AnnotationData):
                 self.type = annotation_type
                 x, y, w, h = value['x'], value['y'], value['width'], value['height']
 
-                self.points.append([x, y])
-                self.points.append([x+w, y])
-                self.points.append([x+w, y+h])
-                self.points.append([x, y+h])
-                self.points.append(self.points[0])
+                self.points = np.array([
+                    [x, y],
+                    [x+w, y],
+                    [x+w, y+h],
+                    [x, y+h],
+                    [x, y]
+                ], dtype=np.float64)
                 
                 self.image_rotation = part['image_rotation']
             case 'polygon':
                 self.type = annotation_type
-                for x, y in value['points']:
-                    self.points.append([round(x), round(y)])
-                self.points.append(self.points[0])
+                points = value['points']
+                self.points = np.array(points + points[:1], dtype=np.float64).round()
                 
                 self.image_rotation = part['image_rotation']
             case _:
@@ -77,12 +105,13 @@ class Region(AnnotationData):
     
     @property
     def bounding_box(self):
-        min_x, max_x = min(p[0] for p in self.points), max(p[0] for p in self.points)
-        min_y, max_y = min(p[1] for p in self.points), max(p[1] for p in self.points)
+        min_x, min_y = self.points.min(axis=0).tolist()
+        max_x, max_y = self.points.max(axis=0).tolist()
         return (min_x, min_y, max_x, max_y)
 
 
-@dataclasses.dataclass
+@register_data_type
+@dataclasses.dataclass(slots=True)
 class Choices(AnnotationData):
     choices: list[str] = dataclasses.field(default_factory=list)
 
@@ -100,57 +129,137 @@ class Choices(AnnotationData):
                 pass      
 
 
-@dataclasses.dataclass
+class _VersionedDict(dict):
+    """
+    dict that counts its mutations, so views built from it know when they are stale.
+    """
+    __slots__ = ('version',)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.version = 0
+
+    def __reduce__(self):
+        return type(self), (dict(self),)
+
+
+def _counting(method):
+    def wrapper(self, *args, **kwargs):
+        self.version += 1
+        return method(self, *args, **kwargs)
+    wrapper.__name__ = method.__name__
+    return wrapper
+
+
+for _name in ('__setitem__', '__delitem__', '__ior__', 'pop', 'popitem', 'clear', 'update', 'setdefault'):
+    setattr(_VersionedDict, _name, _counting(getattr(dict, _name)))
+
+
+@dataclasses.dataclass(slots=True)
 class Annotation:
     id: str
-    data: dict[str, AnnotationData] = dataclasses.field(default_factory=dict)
-    # regions: dict[str, Region] = dataclasses.field(default_factory=dict)
+    data: dict[str, AnnotationData] = dataclasses.field(default_factory=_VersionedDict)
     image_rotation: int = 0
+    updated_at: str | None = None
+    # (data, data version, regions, categories), rebuilt when data changes
+    _views: tuple | None = dataclasses.field(default=None, init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        if not isinstance(self.data, _VersionedDict):
+            self.data = _VersionedDict(self.data)
 
     @classmethod
     def from_json(cls, data) -> "Annotation":
-        annotation = cls(id=data['id'])
+        annotation = cls(id=data['id'], updated_at=data.get('updated_at'))
 
         # Split parts by id
-        data_by_id: dict[str, list[dict]] = {}
+        parts_by_id: dict[str, list[dict]] = {}
         for part in data['result']:
-            _id = part['id']
-            if _id not in data_by_id:
-                data_by_id[_id] = []
-            data_by_id[_id].append(part)
-        
+            parts_by_id.setdefault(part['id'], []).append(part)
+
         # Create annotation data
-        for _id, parts in data_by_id.items():
-            types = set(part["type"] for part in parts)
-
-            for cls in AnnotationData.__subclasses__():
-                if cls.is_instance(types):
-                    annotation_data = cls(id=_id)
-                    for part in parts:
-                        annotation_data.process_part(part)
-                    annotation.data[_id] = annotation_data
-                    break
-            else:
+        rotations = []
+        for _id, parts in parts_by_id.items():
+            data_type = find_data_type(frozenset([part["type"] for part in parts]))
+            if data_type is None:
                 warnings.warn(f"Failed to find type of annotation data {_id} of annotation {annotation.id}")
+                continue
+
+            annotation_data = data_type(id=_id)
+            for part in parts:
+                annotation_data.process_part(part)
+            annotation.data[_id] = annotation_data
 
-        annotation.image_rotation = mean(region.image_rotation for region in annotation.regions.values()) 
+            if isinstance(annotation_data, Region):
+                rotations.append(annotation_data.image_rotation)
+
+        annotation.image_rotation = fmean(rotations)
         return annotation
-    
+
+    def _get_views(self) -> tuple:
+        data, views = self.data, self._views
+        # A plain dict assigned after init has no version, so it is never cached
+        version = getattr(data, 'version', None)
+        if views is None or views[0] is not data or version is None or views[1] != version:
+            regions, categories = {}, []
+            for i, item in data.items():
+                if isinstance(item, Region):
+                    regions[i] = item
+                elif isinstance(item, Choices):
+                    categories.extend(item.choices)
+            views = self._views = (data, version, regions, tuple(categories))
+        return views
+
     @property
-    def regions(self):
-        return {i: data for i, data in self.data.items() if isinstance(data, Region)}
-    
+    def regions(self) -> MappingProxyType[str, Region]:
+        return MappingProxyType(self._get_views()[2])
+
     @property
-    def data_categories(self):
-        categories = []
-        for data in self.data.values():
-            if not isinstance(data, Choices):
-                continue
-            categories.extend(data.choices)
-        return tuple(categories)
+    def data_categories(self) -> tuple[str, ...]:
+        return self._get_views()[3]
+
+    def _region_points(self) -> tuple[np.ndarray, np.ndarray]:
+        # Points of all regions in one array, and the index each region starts at
+        regions = self.regions.values()
+        points = np.concatenate([region.points for region in regions])
+        starts = np.cumsum([0] + [len(region.points) for region in regions])[:-1]
+        return points, starts
+
+    @property
+    def bounding_boxes(self) -> np.ndarray:
+        """
+        Bounding boxes of all regions, as an (N, 4) array of x1, y1, x2, y2 in percent.
+        """
+        if not self.regions:
+            return np.empty((0, 4))
+        points, starts = self._region_points()
+        return np.concatenate([
+            np.minimum.reduceat(points, starts),
+            np.maximum.reduceat(points, starts)
+        ], axis=1)
+
+    @property
+    def rotated_boxes(self) -> np.ndarray:
+        """
+        `bounding_boxes` rotated by the annotation's image rotation.
+        """
+        # utils pulls in OpenCV, which parsing annotations doesn't need
+        from ..utils import rotate_ls_boxes
+
+        return rotate_ls_boxes(self.bounding_boxes, self.image_rotation)
+
+    def region_contours(self, width: int, height: int) -> list[np.ndarray]:
+        """
+        Contours of all regions in pixels of a `width` x `height` image.
+        """
+        if not self.regions:
+            return []
+        points, starts = self._region_points()
+        points = (points / 100 * (width, height)).astype(np.int32)
+        return np.split(points, starts[1:])
 
 
-@dataclasses.dataclass
+@dataclasses.dataclass(slots=True)
 class Task:
     id: str
     image_url: str = dataclasses.field(init=False)
@@ -160,5 +269,7 @@ class Task:
 __all__ = [
     'Task',
     'Annotation',
-    'Region'
+    'Region',
+    'Choices',
+    'register_data_type'
 ]
@@ -1,12 +1,57 @@
-from .base import *
+import importlib
+from typing import TYPE_CHECKING
 
-from .trocr import *
-from .yolo import *
-from .craft import *
+if TYPE_CHECKING:
+    from .base import *
+    from .source import *
+    from .trocr import *
+    from .yolo import *
+    from .craft import *
+    from .multi import *
 
-builders = [
-    TrOCRBuilder, YoloBuilder, CraftBuilder
-]
-builder_names = [
-    b.name for b in builders
+# Builder name -> module and class, so a builder's dependencies are only
+# imported once it's picked
+_builder_classes = {
+    'trocr': ('.trocr', 'TrOCRBuilder'),
+    'yolo': ('.yolo', 'YoloBuilder'),
+    'craft': ('.craft', 'CraftBuilder'),
+}
+builder_names = list(_builder_classes)
+
+# Everything else this package exports, imported on first access
+_lazy_exports = {
+    'Builder': '.base',
+    'TaskOutput': '.base',
+    'WholeImageBuilder': '.base',
+    'SourceImage': '.source',
+    'jpeg_size': '.source',
+    'jpeg_orientation': '.source',
+    'decode_scaled': '.source',
+    'decode_image': '.source',
+    'MultiBuilder': '.multi',
+    'MultiTaskOutput': '.multi',
+    **{class_name: module for module, class_name in _builder_classes.values()},
+}
+
+
+def get_builder(name: str) -> type["Builder"]:
+    if name not in _builder_classes:
+        raise ValueError(f'Unknown dataset type {name}')
+    module, class_name = _builder_classes[name]
+    return getattr(importlib.import_module(module, __name__), class_name)
+
+
+def __getattr__(name: str):
+    if name == 'builders':
+        return [get_builder(builder_name) for builder_name in builder_names]
+    if name in _lazy_exports:
+        return getattr(importlib.import_module(_lazy_exports[name], __name__), name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+__all__ = [
+    'builders',
+    'builder_names',
+    'get_builder',
+    *_lazy_exports
 ]
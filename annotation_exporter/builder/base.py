@@ -1,24 +1,373 @@
+import json
+import hashlib
+import contextlib
+import dataclasses
+import multiprocessing
 from abc import ABC, abstractmethod
-from typing import List
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple, TypeVar
+
+import cv2
 
 from annotation_exporter.s3 import S3Context
-from annotation_exporter.exporter import Exporter
-from annotation_exporter.annotations import Task
+from annotation_exporter.exporter import Exporter, ManifestExporter
+from annotation_exporter.annotations import Task, Shard
+from annotation_exporter.stats import stats
+from ..utils import rotate_image
+from .source import SourceImage
+from .parallel import SharedImage, init_worker, render_in_worker
+
+
+T = TypeVar('T')
+
+
+@dataclasses.dataclass
+class TaskOutput:
+    # (path, content) pairs, written to every exporter
+    files: List[Tuple[str, bytes]] = dataclasses.field(default_factory=list)
+    # Builder-specific records collected for `finalize`
+    rows: List[dict] = dataclasses.field(default_factory=list)
 
 
 class Builder(ABC):
-    def __init__(self, s3_context: S3Context):
+    # Whether output file names depend on the task's position in the input
+    index_in_names = False
+
+    def __init__(
+        self,
+        s3_context: S3Context,
+        workers: int = 1,
+        prefetch: Optional[int] = None,
+        processes: int = 1,
+        max_size: Optional[int] = None,
+        jpeg_quality: int = 100,
+        shard: Optional[Shard] = None
+    ):
         self.s3_context = s3_context
+        self.workers = max(1, workers)
+        # How many images may be downloaded ahead of the task being processed
+        self.prefetch = max(0, prefetch if prefetch is not None else 2 * self.workers)
+        self.processes = max(1, processes)
+        # Longest side of exported images, they're decoded at reduced scale when larger
+        self.max_size = max_size
+        self.jpeg_quality = jpeg_quality
+        # Slice of the tasks this run exports, files all shards write are named after it
+        self.shard = shard
+        # Tasks whose image couldn't be fetched, by id, with their errors
+        self.failed_tasks: Dict[str, BaseException] = {}
+
+    def build_dataset(self, tasks: Iterable[Task], exporters: List[Exporter]):
+        """
+        Consumes tasks as they arrive, exporting each one as soon as its image is
+        ready, and finalizes the dataset once the iterator is exhausted.
+
+        When every exporter keeps a manifest, tasks that it shows as exported
+        and unchanged are skipped without downloading their images.
+
+        Tasks whose image can't be fetched, once retries are exhausted, are left
+        out of the dataset and collected in `failed_tasks` instead of being raised.
+        They're not recorded in manifests, so a resumed run tries them again.
+        """
+        manifests = [e for e in exporters if isinstance(e, ManifestExporter)]
+        if len(manifests) != len(exporters):
+            manifests = []
+
+        def prepare(index: int, task: Task):
+            try:
+                fingerprint = self.fingerprint(index, task) if manifests else None
+                if fingerprint is not None and all(m.is_current(str(task.id), fingerprint) for m in manifests):
+                    return fingerprint, True, None
+                image = self.load_image(task) if self.needs_image(task) else None
+            except Exception as e:
+                # Not rendered, the loop below leaves it out
+                self.failed_tasks[str(task.id)] = e
+                return None, True, None
+            if self.processes > 1 and image is not None:
+                # Copied here, on the prefetch threads, rather than pickled later
+                image = dataclasses.replace(
+                    image,
+                    data=bytes(image.data),
+                    array=SharedImage.from_array(image.array) if image.array is not None else None
+                )
+            return fingerprint, False, image
+
+        def release(prepared):
+            _, _, image = prepared
+            if image is not None and isinstance(image.array, SharedImage):
+                image.array.unlink()
+
+        # Writers opened by `start` are completed after `finalize`, or dropped on errors
+        with contextlib.ExitStack() as resources:
+            self.start(exporters, resources)
+
+            # Closed on errors too, so images prefetched for tasks never reached are released
+            prepared = resources.enter_context(contextlib.closing(self.iter_prepared(tasks, prepare, release)))
+            for index, task, fingerprint, output in self._iter_rendered(prepared):
+                key = str(task.id)
+                if key in self.failed_tasks:
+                    stats.count('tasks.failed')
+                    continue
+                if output is None:
+                    for m in manifests:
+                        m.keep_task(key)
+                    self.skip_task(index, task)
+                    stats.count('tasks.skipped')
+                    continue
+
+                for m in manifests:
+                    m.start_task(key)
+                with stats.timer('task.export'):
+                    self.export_output(index, task, output, exporters)
+                for m in manifests:
+                    m.finish_task(key, fingerprint)
+                stats.count('tasks.exported')
+
+            self.finalize(exporters)
+        for m in manifests:
+            m.save(complete=True)
 
     @abstractmethod
-    def build_dataset(self, tasks: List[Task], exporters: List[Exporter]):
+    def render_task(self, index: int, task: Task, image: Optional[SourceImage]) -> TaskOutput:
+        """
+        Produces the task's files. Runs in worker processes with `--processes`,
+        so it must not touch exporters or mutate the builder.
+        """
+        pass
+
+    def render_task_timed(self, index: int, task: Task, image: Optional[SourceImage]) -> TaskOutput:
+        with stats.timer('task.render'):
+            output = self.render_task(index, task, image)
+        stats.count('tasks.rendered')
+        return output
+
+    def export_output(self, index: int, task: Task, output: TaskOutput, exporters: List[Exporter]):
+        for path, data in output.files:
+            for exporter in exporters:
+                exporter.export_bytes(data, path)
+
+    def start(self, exporters: List[Exporter], resources: contextlib.ExitStack):
+        """
+        Called before the first task. Writers for files streamed over the whole
+        run, see `Exporter.open_writer`, are entered on `resources`.
+        """
+        pass
+
+    def skip_task(self, index: int, task: Task):
+        """Called instead of `render_task` and `export_output` for tasks that are already exported."""
+        pass
+
+    def finalize(self, exporters: List[Exporter]):
+        """Exports files that depend on the whole dataset, called after the last task."""
+        pass
+
+    def merge_shards(self, shard_count: int, exporters: List[Exporter]):
+        """
+        Combines the files every one of `shard_count` shards wrote to the same
+        exporters, named with `shard_file`, into the files of a single run.
+        """
         pass
 
+    def shard_file(self, path: str) -> str:
+        """Name of a file that depends on the whole dataset, in this run's shard."""
+        return path if self.shard is None else self.shard.file_name(path)
+
+    @staticmethod
+    def read_shard_files(path: str, shard_count: int, exporter: Exporter) -> List[bytes]:
+        """The `path` file of every shard, in shard order."""
+        files = []
+        for index in range(1, shard_count + 1):
+            shard_path = Shard(index, shard_count).file_name(path)
+            data = exporter.read_bytes(shard_path)
+            if data is None:
+                raise FileNotFoundError(f"{shard_path} is missing, shard {index}/{shard_count} didn't finish")
+            files.append(data)
+        return files
+
+    def needs_image(self, task: Task) -> bool:
+        return bool(task.annotations)
+
+    def needs_decode(self, task: Task, image: SourceImage) -> bool:
+        """Whether `render_task` needs pixels, rather than just the downloaded file."""
+        return True
+
+    def fingerprint(self, index: int, task: Task) -> str:
+        """Hash of everything the task's exported files depend on."""
+        image_etag = self.s3_context.get_etag(task.image_url) if self.needs_image(task) else None
+        data = {
+            'builder': self.name,
+            'image': [task.image_url, image_etag],
+            'annotations': [[a.id, a.updated_at] for a in task.annotations]
+        }
+        if self.index_in_names:
+            data['index'] = index
+        if (options := self.fingerprint_options()):
+            data['options'] = options
+
+        data = json.dumps(data, sort_keys=True, default=str)
+        return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+    def fingerprint_options(self) -> dict:
+        """Options that change the exported files, so changing them re-exports every task."""
+        options = {}
+        if self.max_size is not None:
+            options['max_size'] = self.max_size
+        if self.jpeg_quality != 100:
+            options['jpeg_quality'] = self.jpeg_quality
+        return options
+
     @property
     @abstractmethod
     def name(): pass
 
+    def image_max_size(self, task: Task) -> Optional[int]:
+        """Longest side the task's image is decoded to, `None` for full size."""
+        return self.max_size
+
+    def load_image(self, task: Task) -> SourceImage:
+        with stats.timer('image.fetch'):
+            image = SourceImage(self.s3_context.download_buffer(task.image_url), max_size=self.image_max_size(task))
+        stats.count('images.fetched')
+        if self.needs_decode(task, image):
+            image.decoded()
+        return image
+
+    def encode_image(self, image: SourceImage, rotation: float) -> bytes:
+        """
+        Returns the image rotated by `rotation` as JPEG. Unrotated JPEGs that don't
+        need resizing are passed through untouched. Each rotation is encoded once
+        per image, shared by annotations and by builders of a `MultiBuilder`.
+        """
+        encoded = image.encoded
+        key = (rotation, self.jpeg_quality)
+        if key not in encoded:
+            if not rotation and image.passes_through:
+                encoded[key] = bytes(image.data)
+                stats.count('images.passed_through')
+            else:
+                to_save = rotate_image(image.decoded(), rotation)
+                with stats.timer('image.encode'):
+                    _, image_bytes = cv2.imencode(".jpg", to_save, [cv2.IMWRITE_JPEG_QUALITY, self.jpeg_quality])
+                encoded[key] = image_bytes.tobytes()
+                stats.count('images.encoded')
+        return encoded[key]
+
+    def _iter_rendered(self, prepared: Iterator[Tuple[int, Task, Tuple[Optional[str], bool, Any]]]):
+        """
+        Renders prepared tasks in this process, or on a pool of `processes`
+        workers, yielding outputs in input order. Unchanged tasks yield `None`.
+        """
+        if self.processes == 1:
+            for index, task, (fingerprint, unchanged, image) in prepared:
+                output = None if unchanged else self.render_task_timed(index, task, image)
+                yield index, task, fingerprint, output
+            return
+
+        pending: deque[Tuple[int, Task, Optional[str], Any, Optional[Future]]] = deque()
+
+        def resolve():
+            index, task, fingerprint, image, future = pending.popleft()
+            try:
+                if future is None:
+                    return index, task, fingerprint, None
+                output, measurements = future.result()
+                stats.merge(measurements)
+                return index, task, fingerprint, output
+            finally:
+                if image is not None and image.array is not None:
+                    image.array.unlink()
+
+        # Forking next to the prefetch threads and OpenCV's own can deadlock the workers
+        with ProcessPoolExecutor(
+            max_workers=self.processes,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=init_worker,
+            initargs=(self,)
+        ) as pool:
+            try:
+                for index, task, (fingerprint, unchanged, image) in prepared:
+                    future = None if unchanged else pool.submit(render_in_worker, index, task, image)
+                    pending.append((index, task, fingerprint, image, future))
+
+                    if len(pending) > 2 * self.processes:
+                        yield resolve()
+
+                while pending:
+                    yield resolve()
+            finally:
+                for _, _, _, image, future in pending:
+                    if future is not None:
+                        future.cancel()
+                pool.shutdown(wait=True)
+                for _, _, _, image, _ in pending:
+                    if image is not None and image.array is not None:
+                        image.array.unlink()
+
+    def __getstate__(self):
+        # Sent to worker processes once, without the S3 connection
+        state = self.__dict__.copy()
+        state['s3_context'] = None
+        state['failed_tasks'] = {}
+        return state
+
+    def iter_prepared(
+        self,
+        tasks: Iterable[Task],
+        prepare: Callable[[int, Task], T],
+        release: Optional[Callable[[T], None]] = None
+    ) -> Iterator[Tuple[int, Task, T]]:
+        """
+        Runs `prepare` for every task on a pool of `workers` threads, at most
+        `prefetch` tasks ahead of the consumer, and yields the results in input order.
+        When iteration stops early, `release` is called with every result that
+        was prepared but not yielded.
+        """
+        if self.workers == 1 and self.prefetch == 0:
+            for index, task in enumerate(tasks):
+                yield index, task, prepare(index, task)
+            return
+
+        pending: deque[Tuple[int, Task, Future]] = deque()
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='prefetch') as pool:
+                try:
+                    for index, task in enumerate(tasks):
+                        pending.append((index, task, pool.submit(prepare, index, task)))
+
+                        if len(pending) > self.prefetch:
+                            index, task, future = pending.popleft()
+                            yield index, task, future.result()
+
+                    while pending:
+                        index, task, future = pending.popleft()
+                        yield index, task, future.result()
+                finally:
+                    for _, _, future in pending:
+                        future.cancel()
+        finally:
+            # The pool has shut down, every future left is cancelled or done
+            if release is not None:
+                for _, _, future in pending:
+                    if not future.cancelled() and future.exception() is None:
+                        release(future.result())
+
+
+class WholeImageBuilder(Builder):
+    """
+    Base of builders exporting whole images, once for every annotation in a split.
+    Unrotated images that pass through are exported as downloaded, without decoding.
+    """
+    def needs_image(self, task: Task) -> bool:
+        # Annotations outside both splits aren't exported, so neither is their image
+        return any(a.data_categories for a in task.annotations)
+
+    def needs_decode(self, task: Task, image: SourceImage) -> bool:
+        rotated = any(a.image_rotation for a in task.annotations if a.data_categories)
+        return rotated or not image.passes_through
+
 
 __all__ = [
-    'Builder'
+    'Builder',
+    'TaskOutput',
+    'WholeImageBuilder'
 ]
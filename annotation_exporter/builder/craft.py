@@ -1,57 +1,53 @@
-from typing import List 
+from typing import Optional
 
 import numpy as np
-import cv2
 
 from annotation_exporter.annotations import Task
-from annotation_exporter.exporter import Exporter
-from .base import Builder
+from .base import TaskOutput, WholeImageBuilder
+from .source import SourceImage
 from ..utils import *
 
 
-class CraftBuilder(Builder):
+class CraftBuilder(WholeImageBuilder):
     name = "craft"
 
-    def build_dataset(self, tasks: List[Task], exporters: List[Exporter]):
-        for i, task_data in enumerate(tasks):
-            if not task_data.annotations:
-                continue
-
-            # Download image
-            image_bytes = self.s3_context.download_bytes(task_data.image_url)
-            image_bytes = np.frombuffer(image_bytes, dtype=np.uint8)
-
-            # Prepare and save image
-            image = cv2.imdecode(image_bytes, cv2.IMREAD_COLOR)
-
-            for j, annotation in enumerate(task_data.annotations):
-                if not annotation.data_categories:
-                    continue
-
-                task_name = f"{i}{j}"
-                to_save = rotate_image(image, annotation.image_rotation)
-                _, image_bytes = cv2.imencode(".jpg", to_save, [cv2.IMWRITE_JPEG_QUALITY, 100])
+    def render_task(self, i: int, task_data: Task, image: Optional[SourceImage]) -> TaskOutput:
+        output = TaskOutput()
+        if not task_data.annotations:
+            return output
 
-                labels = []
-                for region in annotation.regions.values():
-                    bbox = rotate_ls_box(*region.bounding_box, annotation.image_rotation)
-                    x1, y1, x2, y2 = map(lambda c: c / 100, bbox)
-                    x1 *= region.original_width
-                    x2 *= region.original_width
-                    y1 *= region.original_height
-                    y2 *= region.original_height
-                    bbox = map(int, [x1, y1, x2, y1, x2, y2, x1, y2])
-
-                    labels.append(f"{','.join(str(i) for i in bbox)},{region.text}")
-                labels_data = "\n".join(labels)
-
-                for e in exporters:
-                    if "Training" in annotation.data_categories:
-                        e.export_bytes(image_bytes, f"ch4_training_images/{task_name}.jpg")
-                        e.export_bytes(labels_data.encode("utf-8"), f"ch4_training_localization_transcription_gt/gt_{task_name}.txt")
-
-                    if "Validation" in annotation.data_categories:
-                        e.export_bytes(image_bytes, f"ch4_test_images/{task_name}.jpg")
-                        e.export_bytes(labels_data.encode("utf-8"), f"ch4_test_localization_transcription_gt/gt_{task_name}.txt")
+        for annotation in task_data.annotations:
+            if not annotation.data_categories:
+                continue
 
-    
\ No newline at end of file
+            # Stable across runs and shards, unlike the task's position in the input
+            task_name = f"{task_data.id}_{annotation.id}"
+            image_bytes = self.encode_image(image, annotation.image_rotation)
+
+            regions = annotation.regions.values()
+            sizes = np.array([(r.original_width, r.original_height) for r in regions], dtype=np.float64)
+            if quarter_turns(annotation.image_rotation) in (1, 3):
+                # The exported image is turned on its side
+                sizes = sizes[:, ::-1]
+
+            # scale x1, y1, x2, y2 to pixels of the exported image and expand to the four corners
+            bboxes = (annotation.rotated_boxes / 100 * np.tile(sizes * image.scale, 2)).astype(np.int64)
+            x1, y1, x2, y2 = bboxes.T
+            corners = np.stack([x1, y1, x2, y1, x2, y2, x1, y2], axis=1)
+
+            labels = [
+                f"{','.join(str(i) for i in bbox)},{region.text}"
+                for bbox, region in zip(corners.tolist(), regions)
+            ]
+            labels_data = "\n".join(labels).encode("utf-8")
+
+            if "Training" in annotation.data_categories:
+                output.files.append((f"ch4_training_images/{task_name}.jpg", image_bytes))
+                output.files.append((f"ch4_training_localization_transcription_gt/gt_{task_name}.txt", labels_data))
+
+            if "Validation" in annotation.data_categories:
+                output.files.append((f"ch4_test_images/{task_name}.jpg", image_bytes))
+                output.files.append((f"ch4_test_localization_transcription_gt/gt_{task_name}.txt", labels_data))
+        return output
+
+    
@@ -0,0 +1,99 @@
+import contextlib
+import dataclasses
+from typing import List, Optional
+
+from annotation_exporter.s3 import S3Context
+from annotation_exporter.annotations import Task
+from annotation_exporter.exporter import Exporter
+from .base import Builder, TaskOutput
+from .source import SourceImage
+
+
+@dataclasses.dataclass
+class MultiTaskOutput(TaskOutput):
+    # One output per builder, in builder order
+    parts: List[TaskOutput] = dataclasses.field(default_factory=list)
+
+
+class MultiBuilder(Builder):
+    """
+    Builds several datasets in one pass: every task's image is downloaded and
+    decoded once, then rendered by each builder and exported to its own targets.
+
+    `build_dataset` must be given every exporter of `targets`, which it uses to
+    resume; files are routed to each builder's targets.
+    """
+    def __init__(
+        self,
+        s3_context: S3Context,
+        builders: List[Builder],
+        targets: List[List[Exporter]],
+        **kwargs
+    ):
+        super().__init__(s3_context, **kwargs)
+        if len(builders) != len(targets):
+            raise ValueError('Every builder needs its own list of exporters')
+        self.builders = builders
+        self.targets = targets
+        self.index_in_names = any(b.index_in_names for b in builders)
+
+    @property
+    def name(self) -> str:
+        return '+'.join(b.name for b in self.builders)
+
+    def render_task(self, index: int, task: Task, image: Optional[SourceImage]) -> TaskOutput:
+        output = MultiTaskOutput()
+        for builder in self.builders:
+            builder_image = None
+            if image is not None and builder.needs_image(task):
+                builder_image = image.resized(builder.image_max_size(task))
+            output.parts.append(builder.render_task(index, task, builder_image))
+        return output
+
+    def export_output(self, index: int, task: Task, output: MultiTaskOutput, exporters: List[Exporter]):
+        for builder, part, targets in zip(self.builders, output.parts, self.targets):
+            builder.export_output(index, task, part, targets)
+
+    def start(self, exporters: List[Exporter], resources: contextlib.ExitStack):
+        for builder, targets in zip(self.builders, self.targets):
+            builder.start(targets, resources)
+
+    def skip_task(self, index: int, task: Task):
+        for builder in self.builders:
+            builder.skip_task(index, task)
+
+    def finalize(self, exporters: List[Exporter]):
+        for builder, targets in zip(self.builders, self.targets):
+            builder.finalize(targets)
+
+    def merge_shards(self, shard_count: int, exporters: List[Exporter]):
+        for builder, targets in zip(self.builders, self.targets):
+            builder.merge_shards(shard_count, targets)
+
+    def needs_image(self, task: Task) -> bool:
+        return any(b.needs_image(task) for b in self.builders)
+
+    def needs_decode(self, task: Task, image: SourceImage) -> bool:
+        return any(b.needs_decode(task, image) for b in self.builders if b.needs_image(task))
+
+    def image_max_size(self, task: Task) -> Optional[int]:
+        # Large enough for the builder that needs the most pixels
+        sizes = [b.image_max_size(task) for b in self.builders if b.needs_image(task)]
+        if not sizes or None in sizes:
+            return None
+        return max(sizes)
+
+    def fingerprint_options(self) -> dict:
+        return {b.name: b.fingerprint_options() for b in self.builders}
+
+    def __getstate__(self):
+        # Exporters stay in this process, workers only render
+        state = super().__getstate__()
+        state['targets'] = None
+        return state
+
+
+__all__ = [
+    'MultiBuilder',
+    'MultiTaskOutput'
+]
@@ -0,0 +1,64 @@
+import dataclasses
+from multiprocessing import shared_memory
+from typing import Optional
+
+import numpy as np
+
+from annotation_exporter.stats import stats
+from .source import SourceImage
+
+
+class SharedImage:
+    """
+    A decoded image placed in shared memory, so worker processes can map it
+    instead of receiving a pickled copy. Only the creating process unlinks it.
+    """
+    def __init__(self, name: str, shape: tuple, dtype: str):
+        self.name = name
+        self.shape = shape
+        self.dtype = dtype
+        self._memory: Optional[shared_memory.SharedMemory] = None
+
+    @classmethod
+    def from_array(cls, array: np.ndarray) -> "SharedImage":
+        memory = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        np.ndarray(array.shape, dtype=array.dtype, buffer=memory.buf)[...] = array
+
+        image = cls(memory.name, array.shape, array.dtype.str)
+        image._memory = memory
+        return image
+
+    def unlink(self):
+        if self._memory is not None:
+            self._memory.close()
+            self._memory.unlink()
+            self._memory = None
+
+    def __getstate__(self):
+        return {'name': self.name, 'shape': self.shape, 'dtype': self.dtype, '_memory': None}
+
+
+_builder = None
+
+
+def init_worker(builder):
+    global _builder
+    _builder = builder
+    # Measurements are sent back with every output
+    stats.buffered = True
+
+
+def render_in_worker(index: int, task, image: Optional[SourceImage]):
+    if image is None or image.array is None:
+        output = _builder.render_task_timed(index, task, image)
+        return output, stats.drain()
+
+    shared = image.array
+    memory = shared_memory.SharedMemory(name=shared.name)
+    source = dataclasses.replace(image, array=np.ndarray(shared.shape, dtype=shared.dtype, buffer=memory.buf))
+    output = _builder.render_task_timed(index, task, source)
+
+    # The mapping can't be closed while arrays still point into it
+    del source
+    memory.close()
+    return output, stats.drain()
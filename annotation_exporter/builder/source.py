@@ -0,0 +1,205 @@
+import dataclasses
+from typing import Dict, Iterator, Optional, Tuple
+
+import cv2
+import numpy as np
+
+from annotation_exporter.stats import stats
+
+
+JPEG_MAGIC = b'\xff\xd8\xff'
+
+# Start of frame markers, which carry the image size. C4, C8 and CC are other segments
+_JPEG_SOF_MARKERS = frozenset(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+# Markers without a length field
+_JPEG_STANDALONE_MARKERS = frozenset([0x01, *range(0xD0, 0xDA)])
+_JPEG_START_OF_SCAN = 0xDA
+_JPEG_APP1 = 0xE1
+_EXIF_ORIENTATION_TAG = 0x0112
+
+# libjpeg can decode straight to 1/8, 1/4 or 1/2 scale, skipping most of the work
+_REDUCED_DECODE = [
+    (8, cv2.IMREAD_REDUCED_COLOR_8),
+    (4, cv2.IMREAD_REDUCED_COLOR_4),
+    (2, cv2.IMREAD_REDUCED_COLOR_2),
+]
+
+
+@dataclasses.dataclass
+class SourceImage:
+    # Image file as downloaded
+    data: bytes | memoryview
+    # Decoded pixels, `None` when the builder can use `data` as is
+    array: Optional[np.ndarray] = None
+    # Longest side to decode to, full size when `None`
+    max_size: Optional[int] = None
+    # Size of `array` relative to the image file
+    scale: float = 1.0
+    # JPEG encodings by (rotation, quality), see `Builder.encode_image`
+    encoded: Dict[Tuple[float, int], bytes] = dataclasses.field(default_factory=dict, repr=False)
+
+    @property
+    def is_jpeg(self) -> bool:
+        return bytes(self.data[:3]) == JPEG_MAGIC
+
+    @property
+    def needs_resize(self) -> bool:
+        """Whether the image can't be used at its file's resolution because of `max_size`."""
+        if self.max_size is None:
+            return False
+        if self.array is not None:
+            return self.scale != 1.0
+        size = jpeg_size(self.data)
+        return size is None or max(size) > self.max_size
+
+    @property
+    def passes_through(self) -> bool:
+        """
+        Whether the downloaded file can be exported as is, when it isn't rotated.
+        JPEGs stored sideways with an EXIF orientation are decoded, which turns
+        them upright, since annotations are in upright coordinates.
+        """
+        return self.is_jpeg and not self.needs_resize and jpeg_orientation(self.data) == 1
+
+    def decoded(self) -> np.ndarray:
+        if self.array is None:
+            self.array, self.scale = decode_scaled(self.data, self.max_size)
+        return self.array
+
+    def resized(self, max_size: Optional[int]) -> "SourceImage":
+        """
+        The same image for a consumer with its own `max_size`. Decoded pixels
+        are scaled down from this image's rather than decoded again.
+        """
+        if max_size is None or (self.max_size is not None and max_size >= self.max_size):
+            return self
+        if self.array is None:
+            return SourceImage(self.data, max_size=max_size)
+
+        # Longest side of the image file
+        longest = round(max(self.array.shape[:2]) / self.scale)
+        array, scale = _fit(self.array, max_size, longest)
+        if array is self.array:
+            return SourceImage(self.data, self.array, max_size, self.scale)
+        return SourceImage(self.data, array, max_size, scale)
+
+
+def _jpeg_segments(data: bytes | memoryview) -> Iterator[Tuple[int, memoryview]]:
+    """Markers and payloads of a JPEG's segments, up to its frame header or scan."""
+    data = memoryview(data)
+    if bytes(data[:3]) != JPEG_MAGIC:
+        return
+
+    i = 2
+    while i + 4 <= len(data):
+        if data[i] != 0xFF:
+            return
+        marker = data[i + 1]
+        if marker == 0xFF:
+            # fill byte
+            i += 1
+        elif marker in _JPEG_STANDALONE_MARKERS:
+            i += 2
+        else:
+            length = int.from_bytes(data[i + 2:i + 4], 'big')
+            yield marker, data[i + 4:i + 2 + length]
+            if marker in _JPEG_SOF_MARKERS or marker == _JPEG_START_OF_SCAN:
+                return
+            i += 2 + length
+
+
+def jpeg_size(data: bytes | memoryview) -> Optional[Tuple[int, int]]:
+    """
+    Width and height from a JPEG's frame header, without decoding it. They're
+    the stored size, before any EXIF orientation is applied.
+    `None` if `data` isn't a JPEG or the header can't be found.
+    """
+    for marker, payload in _jpeg_segments(data):
+        if marker in _JPEG_SOF_MARKERS and len(payload) >= 5:
+            height = int.from_bytes(payload[1:3], 'big')
+            width = int.from_bytes(payload[3:5], 'big')
+            return width, height
+    return None
+
+
+def jpeg_orientation(data: bytes | memoryview) -> int:
+    """
+    EXIF orientation of a JPEG, from 1 to 8, without decoding it. 1, stored
+    upright, when there's no orientation tag or `data` isn't a JPEG.
+    """
+    for marker, payload in _jpeg_segments(data):
+        if marker != _JPEG_APP1 or bytes(payload[:6]) != b'Exif\0\0':
+            continue
+        tiff = payload[6:]
+        match bytes(tiff[:2]):
+            case b'II':
+                order = 'little'
+            case b'MM':
+                order = 'big'
+            case _:
+                return 1
+        ifd = int.from_bytes(tiff[4:8], order)
+        if ifd + 2 > len(tiff):
+            return 1
+        for entry in range(int.from_bytes(tiff[ifd:ifd + 2], order)):
+            offset = ifd + 2 + entry * 12
+            if offset + 12 > len(tiff):
+                break
+            if int.from_bytes(tiff[offset:offset + 2], order) == _EXIF_ORIENTATION_TAG:
+                orientation = int.from_bytes(tiff[offset + 8:offset + 10], order)
+                return orientation if 1 <= orientation <= 8 else 1
+        return 1
+    return 1
+
+
+def decode_scaled(data: bytes | memoryview, max_size: Optional[int] = None) -> Tuple[np.ndarray, float]:
+    """
+    Decodes an image so that its longest side is at most `max_size`, returning
+    the pixels and their scale relative to the file. JPEGs are decoded at
+    reduced scale when they're at least twice as large, then resized down.
+    """
+    size = jpeg_size(data) if max_size is not None else None
+    flags = cv2.IMREAD_COLOR
+    if size is not None:
+        for reduction, reduced_flags in _REDUCED_DECODE:
+            if max(size) // reduction >= max_size:
+                flags = reduced_flags
+                break
+
+    with stats.timer('image.decode'):
+        array = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), flags)
+    stats.count('images.decoded')
+
+    if max_size is None:
+        return array, 1.0
+    # EXIF orientation may have swapped the sides, the longest one is the same either way
+    return _fit(array, max_size, max(size) if size is not None else max(array.shape[:2]))
+
+
+def _fit(array: np.ndarray, max_size: int, longest: int) -> Tuple[np.ndarray, float]:
+    # Scales pixels of an image file with a `longest` side down to `max_size`
+    if longest <= max_size:
+        return array, 1.0
+    if max(array.shape[:2]) <= max_size:
+        return array, max(array.shape[:2]) / longest
+
+    height, width = array.shape[:2]
+    factor = max_size / max(height, width)
+    target = (max(1, round(width * factor)), max(1, round(height * factor)))
+    if target != (width, height):
+        with stats.timer('image.resize'):
+            array = cv2.resize(array, target, interpolation=cv2.INTER_AREA)
+    return array, max_size / longest
+
+
+def decode_image(data: bytes | memoryview, max_size: Optional[int] = None) -> np.ndarray:
+    return decode_scaled(data, max_size)[0]
+
+
+__all__ = [
+    'SourceImage',
+    'jpeg_size',
+    'jpeg_orientation',
+    'decode_scaled',
+    'decode_image'
+]
@@ -1,71 +1,126 @@
 import io
 import csv
-from typing import List
+import math
+import contextlib
+from typing import BinaryIO, List, Optional
 
 import cv2
 import numpy as np
 
-from annotation_exporter.annotations import Task
+from annotation_exporter.annotations import Task, Region
 from annotation_exporter.exporter import Exporter
-from .base import Builder
-from ..utils import rotate_image
+from .base import Builder, TaskOutput
+from .source import SourceImage
+from ..stats import stats
+from ..utils import crop_rotated_polygon, resize_to_height
 
 
 class TrOCRBuilder(Builder):
     name = "trocr" 
 
-    def build_dataset(self, tasks: List[Task], exporters: List[Exporter]):
-        data = []
-
-        for task_data in tasks:
-            image_bytes = self.s3_context.download_bytes(task_data.image_url)
-            image_bytes = np.frombuffer(image_bytes, dtype=np.uint8)
-            image = cv2.imdecode(image_bytes, cv2.IMREAD_COLOR)
-
-            for annotation in task_data.annotations:
-                for region_id, region in annotation.regions.items():
-                    print('Processing', region_id)
-
-                    # create contour out of label studio points
-                    image_height, image_width = image.shape[:2]
-                    contour = [[x / 100 * image_width, y / 100 * image_height] for x, y in region.points]
-                    contour = np.array(contour).reshape((-1,1,2)).astype(np.int32)
-
-                    # get contour bounding box
-                    x, y, w, h = cv2.boundingRect(contour)
-
-                    # create mask
-                    mask = np.zeros([image_height, image_width], dtype=np.uint8)
-                    cv2.fillPoly(mask, [contour], 255)
-                    
-                    # crop mask and image
-                    mask = mask[y:y+h, x:x+w]
-                    image_part = image[y:y+h, x:x+w]
-
-                    # mask shenanigans
-                    text_part = cv2.bitwise_and(image_part, image_part, mask=mask)
-                    white_bg = np.full_like(image_part, 255)
-                    white_part = cv2.bitwise_and(white_bg, white_bg, mask=cv2.bitwise_not(mask))
-
-                    image_part = cv2.add(text_part, white_part)
-
-                    # rotate image if it was rotated in Label Studio
-                    image_part = rotate_image(image_part, region.image_rotation)
-
-                    # save image
-                    filename = f'{region_id}.jpg'
+    def __init__(self, *args, line_height: Optional[int] = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Height every line image is scaled to, as cropped when `None`
+        self.line_height = line_height
+        # data.csv of every exporter, rows are appended as tasks are exported
+        self._csv_writers: List[BinaryIO] = []
+
+    def image_max_size(self, task: Task) -> Optional[int]:
+        max_size = super().image_max_size(task)
+        if self.line_height is None:
+            return max_size
+
+        # The thinnest line decides how far the image can be scaled down
+        thinnest, longest = math.inf, 0
+        for annotation in task.annotations:
+            if not annotation.regions:
+                continue
+            sizes = np.array(
+                [(r.original_width, r.original_height) for r in annotation.regions.values()],
+                dtype=np.float64
+            )
+            boxes = annotation.bounding_boxes
+            pixels = (boxes[:, 2:] - boxes[:, :2]) / 100 * sizes
+            thinnest = min(thinnest, pixels.min())
+            longest = max(longest, sizes.max())
+
+        if thinnest <= self.line_height:
+            return max_size
+        line_max_size = math.ceil(longest * self.line_height / thinnest)
+        return line_max_size if max_size is None else min(line_max_size, max_size)
+
+    def fingerprint_options(self) -> dict:
+        options = super().fingerprint_options()
+        if self.line_height is not None:
+            options['line_height'] = self.line_height
+        return options
+
+    def render_task(self, index: int, task_data: Task, image: Optional[SourceImage]) -> TaskOutput:
+        output = TaskOutput()
+        for annotation in task_data.annotations:
+            if not annotation.regions:
+                continue
+
+            # create contours out of label studio points
+            pixels = image.decoded()
+            image_height, image_width = pixels.shape[:2]
+            contours = annotation.region_contours(image_width, image_height)
+
+            for (region_id, region), contour in zip(annotation.regions.items(), contours):
+                # cut out the region on a white background, upright if the image
+                # was rotated in Label Studio
+                with stats.timer('region.crop'):
+                    image_part = crop_rotated_polygon(pixels, contour, region.image_rotation)
+
+                    if self.line_height is not None:
+                        image_part = resize_to_height(image_part, self.line_height)
+                stats.count('regions.cropped')
+
+                # save image
+                with stats.timer('image.encode'):
                     _, image_buffer = cv2.imencode('.jpg', image_part)
-                    image_bytes = image_buffer.tobytes()
-
-                    for exporter in exporters:
-                        exporter.export_bytes(image_bytes, f"images/{region.id}.jpg")
-
-                    # add to data csv
-                    data.append({
-                        'image': filename,
-                        'text': region.text
-                    })
-        
+                image_bytes = image_buffer.tobytes()
+                stats.count('images.encoded')
+
+                output.files.append((f"images/{region.id}.jpg", image_bytes))
+
+                # add to data csv
+                output.rows.append(self._csv_row(region_id, region))
+        return output
+
+    def start(self, exporters: List[Exporter], resources: contextlib.ExitStack):
+        path = self.shard_file('data.csv')
+        self._csv_writers = [resources.enter_context(e.open_writer(path)) for e in exporters]
+        resources.callback(self._csv_writers.clear)
+        self._write_rows([], header=True)
+
+    def export_output(self, index: int, task_data: Task, output: TaskOutput, exporters: List[Exporter]):
+        super().export_output(index, task_data, output, exporters)
+        self._write_rows(output.rows)
+
+    def skip_task(self, index: int, task_data: Task):
+        # Images are already exported, but data.csv still needs the rows
+        self._write_rows([
+            self._csv_row(region_id, region)
+            for annotation in task_data.annotations
+            for region_id, region in annotation.regions.items()
+        ])
+
+    def merge_shards(self, shard_count: int, exporters: List[Exporter]):
+        for exporter in exporters:
+            parts = self.read_shard_files('data.csv', shard_count, exporter)
+            # Every part starts with the header, it's kept once
+            rows = [part.split(b'\n', 1)[1] for part in parts[1:]]
+            exporter.export_bytes(b''.join([parts[0], *rows]), 'data.csv')
+
+    @staticmethod
+    def _csv_row(region_id: str, region: Region) -> dict:
+        return {
+            'image': f'{region_id}.jpg',
+            'text': region.text
+        }
+
+    def _write_rows(self, rows: List[dict], header: bool = False):
         with io.StringIO() as csv_file:
             csv_writer = csv.DictWriter(csv_file, 
                                         fieldnames=['image', 'text'], 
@@ -73,14 +128,22 @@ class TrOCRBuilder(Builder):
                                         dialect='unix',
                                         escapechar='\\',
                                         quoting=csv.QUOTE_NONE)
-            csv_writer.writeheader()
-            csv_writer.writerows(data)
-            csv_file.seek(0)
-            csv_data = csv_file.read()
-        
+            if header:
+                csv_writer.writeheader()
+            csv_writer.writerows(rows)
+            csv_data = csv_file.getvalue()
+
+        if not csv_data:
+            return
         csv_bytes = csv_data.encode(encoding='utf-8')
-        for exporter in exporters:
-            exporter.export_bytes(csv_bytes, 'data.csv')
+        for writer in self._csv_writers:
+            writer.write(csv_bytes)
+
+    def __getstate__(self):
+        # Writers stay in this process, workers only render
+        state = super().__getstate__()
+        state['_csv_writers'] = []
+        return state
 
 
 __all__ = [
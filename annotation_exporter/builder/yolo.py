@@ -1,73 +1,70 @@
 import warnings
-from typing import List
+from typing import List, Optional
 
-import cv2
 import numpy as np
 
 from annotation_exporter.annotations import Task
 from annotation_exporter.exporter import Exporter
-from .base import Builder
-from ..utils import *
+from .base import TaskOutput, WholeImageBuilder
+from .source import SourceImage
 
 
-def _ls_to_yolo(x1, y1, x2, y2):
+def _ls_to_yolo(boxes: np.ndarray) -> np.ndarray:
+    x1, y1, x2, y2 = boxes.T
     width, height = x2-x1, y2-y1
     x_center, y_center = x1 + width / 2, y1 + height / 2
-    return [i / 100 for i in (x_center, y_center, width, height)]
+    return np.stack([x_center, y_center, width, height], axis=1) / 100
 
 
-class YoloBuilder(Builder):
+class YoloBuilder(WholeImageBuilder):
     name = "yolo"
 
-    def build_dataset(self, tasks: List[Task], exporters: List[Exporter]):
-        for i, task_data in enumerate(tasks):
-            if not task_data.annotations:
+    def render_task(self, i: int, task_data: Task, image: Optional[SourceImage]) -> TaskOutput:
+        output = TaskOutput()
+        if not task_data.annotations:
+            return output
+
+        for annotation in task_data.annotations:
+            if not annotation.data_categories:
                 continue
 
-            # Download image
-            image_bytes = self.s3_context.download_bytes(task_data.image_url)
-            image_bytes = np.frombuffer(image_bytes, dtype=np.uint8)
-
-            # Prepare and save image
-            image = cv2.imdecode(image_bytes, cv2.IMREAD_COLOR)
-
-            for j, annotation in enumerate(task_data.annotations):
-                if not annotation.data_categories:
-                    continue
-
-                task_name = f"{i}{j}"
-                to_save = rotate_image(image, annotation.image_rotation)
-                _, image_bytes = cv2.imencode(".jpg", to_save, [cv2.IMWRITE_JPEG_QUALITY, 100])
-
-                labels = []
-                for region in annotation.regions.values():
-                    bbox = rotate_ls_box(*region.bounding_box, annotation.image_rotation)
-                    bbox = _ls_to_yolo(*bbox)
-
-                    if any(i < 0 or i > 1 for i in bbox):
-                        warnings.warn(
-                            f"Yolo task {task_name} has values outside [0, 1]",
-                            RuntimeWarning
-                        )
-
-                    # TODO: We need to get an label map from Label Studio somehow
-                    # What's good is that we only use one label and nobody else will ever use this
-                    labels.append(f"0 {' '.join(str(i) for i in bbox)}")
-                labels_data = "\n".join(labels)
-
-                for e in exporters:
-                    if "Training" in annotation.data_categories:
-                        e.export_bytes(image_bytes, f"train/images/{task_name}.jpg")
-                        e.export_bytes(labels_data.encode("utf-8"), f"train/labels/{task_name}.txt")
-
-                    if "Validation" in annotation.data_categories:
-                        e.export_bytes(image_bytes, f"val/images/{task_name}.jpg")
-                        e.export_bytes(labels_data.encode("utf-8"), f"val/labels/{task_name}.txt")
-
-            for e in exporters:
-                yaml = self._get_yaml()
-                e.export_bytes(yaml.encode("utf-8"), "data.yaml")
-        
+            # Stable across runs and shards, unlike the task's position in the input
+            task_name = f"{task_data.id}_{annotation.id}"
+            image_bytes = self.encode_image(image, annotation.image_rotation)
+
+            bboxes = _ls_to_yolo(annotation.rotated_boxes)
+            if ((bboxes < 0) | (bboxes > 1)).any():
+                warnings.warn(
+                    f"Yolo task {task_name} has values outside [0, 1]",
+                    RuntimeWarning
+                )
+
+            # TODO: We need to get an label map from Label Studio somehow
+            # What's good is that we only use one label and nobody else will ever use this
+            labels = [f"0 {' '.join(str(i) for i in bbox)}" for bbox in bboxes.tolist()]
+            labels_data = "\n".join(labels).encode("utf-8")
+
+            if "Training" in annotation.data_categories:
+                output.files.append((f"train/images/{task_name}.jpg", image_bytes))
+                output.files.append((f"train/labels/{task_name}.txt", labels_data))
+
+            if "Validation" in annotation.data_categories:
+                output.files.append((f"val/images/{task_name}.jpg", image_bytes))
+                output.files.append((f"val/labels/{task_name}.txt", labels_data))
+        return output
+
+    def finalize(self, exporters: List[Exporter]):
+        yaml = self._get_yaml()
+        for e in exporters:
+            e.export_bytes(yaml.encode("utf-8"), self.shard_file("data.yaml"))
+
+    def merge_shards(self, shard_count: int, exporters: List[Exporter]):
+        for e in exporters:
+            parts = self.read_shard_files("data.yaml", shard_count, e)
+            if any(part != parts[0] for part in parts):
+                raise ValueError("Shards wrote different data.yaml files")
+            e.export_bytes(parts[0], "data.yaml")
+
     def _get_yaml(self):
         # TODO: Once again, get label map somehow
         text = "train: ../train/images\nval: ../val/images\n\nnc: 1\nnames: ['Handwriting']"
@@ -0,0 +1,116 @@
+import os
+import mmap
+import hashlib
+import tempfile
+import threading
+from pathlib import Path
+
+from .stats import stats
+
+
+class DiskCache:
+    """
+    Persistent content cache for S3 objects, keyed by bucket and key.
+
+    Entries are revalidated with a conditional GET against the stored ETag, so a
+    hit costs a round trip but no egress. The cache is kept under `max_size` bytes
+    by evicting the least recently used entries.
+    """
+    def __init__(
+        self,
+        directory: str | Path,
+        max_size: int,
+        revalidate: bool = True,
+        mmap_threshold: int = 1 << 20
+    ):
+        self.directory = Path(directory).resolve()
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_size = max_size
+        self.revalidate = revalidate
+        self.mmap_threshold = mmap_threshold
+
+        self._lock = threading.Lock()
+        self._size = sum(path.stat().st_size for path in self.directory.glob('*.bin'))
+
+    def fetch(self, client, bucket: str, key: str) -> bytes | mmap.mmap:
+        data_path = self._data_path(bucket, key)
+        etag_path = data_path.with_suffix('.etag')
+
+        etag = None
+        if data_path.exists() and etag_path.exists():
+            etag = etag_path.read_text(encoding='utf-8')
+            if not self.revalidate:
+                return self._hit(data_path)
+
+        from botocore.exceptions import ClientError
+
+        kwargs = {'IfNoneMatch': etag} if etag else {}
+        try:
+            with stats.timer('s3.get'):
+                response = client.get_object(Bucket=bucket, Key=key, **kwargs)
+                data = response['Body'].read()
+        except ClientError as e:
+            if etag and e.response['Error']['Code'] in ('304', 'NotModified'):
+                return self._hit(data_path)
+            raise
+
+        stats.count('cache.misses')
+        stats.count('s3.download.bytes', len(data))
+        self._store(data_path, etag_path, data, response['ETag'])
+        return data
+
+    def _data_path(self, bucket: str, key: str) -> Path:
+        digest = hashlib.sha256(f"{bucket}/{key}".encode('utf-8')).hexdigest()
+        return self.directory / f"{digest}.bin"
+
+    def _hit(self, data_path: Path) -> bytes | mmap.mmap:
+        stats.count('cache.hits')
+        # Access time drives eviction order
+        os.utime(data_path)
+
+        with open(data_path, 'rb') as file:
+            size = os.fstat(file.fileno()).st_size
+            if 0 < size and size >= self.mmap_threshold:
+                return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            return file.read()
+
+    def _store(self, data_path: Path, etag_path: Path, data: bytes, etag: str):
+        previous_size = data_path.stat().st_size if data_path.exists() else 0
+
+        # Write-then-rename, so concurrent readers never see a partial entry
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as file:
+            file.write(data)
+        os.replace(temp_path, data_path)
+        etag_path.write_text(etag, encoding='utf-8')
+
+        with self._lock:
+            self._size += len(data) - previous_size
+            if self._size > self.max_size:
+                self._evict()
+
+    def _evict(self):
+        entries = []
+        for path in self.directory.glob('*.bin'):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        entries.sort()
+
+        # Free some headroom so eviction doesn't run on every store
+        target = self.max_size * 0.9
+        size = sum(size for _, size, _ in entries)
+        for _, entry_size, path in entries:
+            if size <= target:
+                break
+            path.unlink(missing_ok=True)
+            path.with_suffix('.etag').unlink(missing_ok=True)
+            size -= entry_size
+        self._size = size
+
+
+__all__ = [
+    "DiskCache"
+]
@@ -1,2 +1,5 @@
 from .base import *
-from .exporter import *
\ No newline at end of file
+from .exporter import *
+from .manifest import *
+from .multipart import *
+from .shards import *
\ No newline at end of file
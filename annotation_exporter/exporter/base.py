@@ -1,7 +1,13 @@
+import io
+import contextlib
 from abc import ABC, abstractmethod
+from typing import BinaryIO, Dict, Iterator, Optional
 
 
 class Exporter(ABC):
+    # Whether the exporter can be wrapped in a `ManifestExporter` for resumable runs
+    supports_manifest = True
+
     @abstractmethod
     def export_bytes(self, bytes, path: str):
         pass
@@ -10,6 +16,43 @@ class Exporter(ABC):
     def export_file(self, file, path: str):
         pass
 
+    @contextlib.contextmanager
+    def open_writer(self, path: str) -> Iterator[BinaryIO]:
+        """
+        Writable binary file at `path`, for files produced piece by piece. It's
+        complete once the context exits, and isn't written if the context raises.
+
+        By default content is buffered in memory and exported in one piece,
+        exporters that can write incrementally override this.
+        """
+        with io.BytesIO() as buffer:
+            yield buffer
+            self.export_bytes(buffer.getvalue(), path)
+
+    @abstractmethod
+    def read_bytes(self, path: str) -> Optional[bytes]:
+        """Reads back a previously exported file, `None` if it doesn't exist."""
+        pass
+
+    def flush(self):
+        """Blocks until every export so far is written."""
+        pass
+
+    def close(self):
+        self.flush()
+
+    def abort(self):
+        """
+        Called instead of `close` when the run fails. Drops files still being
+        written, rather than leaving them truncated under their final names.
+        """
+        pass
+
+    @property
+    def failed(self) -> Dict[str, BaseException]:
+        """Paths whose export failed in the background, with their errors."""
+        return {}
+
 
 __all__ = [
     'Exporter'
@@ -1,30 +1,217 @@
 import io
+import os
+import hashlib
+import tempfile
+import threading
+import contextlib
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
 from pathlib import Path
+from typing import BinaryIO, Dict, Iterator, Optional, Tuple
 
 from annotation_exporter.s3 import S3Url, S3Context
+from annotation_exporter.stats import stats
 
 from .base import Exporter
+from .multipart import MultipartUploadWriter
+
+
+# Smaller files, like labels, are cheaper to upload again than to hash and copy
+DEDUPLICATE_MIN_SIZE = 64 * 1024
+# Uploads remembered as copy sources, plenty for the files of the tasks in flight
+DEDUPLICATE_ENTRIES = 1024
+
+
+def _get_umask() -> int:
+    # Setting it is the only way to read it, so it's done once at import,
+    # before any writer threads could create files meanwhile
+    umask = os.umask(0o022)
+    os.umask(umask)
+    return umask
+
+
+# Temporary files are created private, they get the mode `open` would have given
+DEFAULT_FILE_MODE = 0o666 & ~_get_umask()
 
 
 class S3Exporter(Exporter):
-    def __init__(self, s3: S3Context, base_url: str | S3Url):
+    """
+    Uploads files to an S3 prefix. With more than one worker, uploads happen on
+    a background pool: `export_bytes` returns once the upload is queued, blocking
+    only while `max_in_flight` bytes are already queued. Failed uploads are
+    collected in `failed` instead of being raised.
+
+    Content that was recently uploaded by this exporter, like an image exported
+    to both splits, is copied server-side from the first key instead.
+    """
+    def __init__(
+        self,
+        s3: S3Context,
+        base_url: str | S3Url,
+        workers: int = 1,
+        max_in_flight: int = 256 * 1024 ** 2
+    ):
         self.s3 = s3
 
         if isinstance(base_url, str):
             base_url = S3Url(base_url)
         self.base_url = base_url
 
+        self.max_in_flight = max_in_flight
+        self._failed: Dict[str, BaseException] = {}
+        self._pool = None
+        if workers > 1:
+            self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='s3-upload')
+        self._condition = threading.Condition()
+        self._in_flight = 0
+        self._pending = 0
+        # Content digest -> key it was uploaded to, and that upload's future until
+        # it succeeds, least recently used first
+        self._uploaded: OrderedDict[bytes, Tuple[S3Url, Optional[Future]]] = OrderedDict()
+        # Key -> digest of its content, for the keys in `_uploaded`
+        self._uploaded_keys: Dict[str, bytes] = {}
+
     def export_bytes(self, bytes, path: str):
         target_url = self._get_target_path(path)
-        object = self.s3.url_to_object(target_url)
 
-        with io.BytesIO(bytes) as input_file:
-            object.upload_fileobj(input_file)
+        digest, source = None, None
+        if len(bytes) >= DEDUPLICATE_MIN_SIZE:
+            digest = hashlib.sha1(bytes).digest()
+        with self._condition:
+            # The key's content is replaced, it can't be copied from any more
+            self._forget(str(target_url))
+            if digest is not None and (source := self._uploaded.get(digest)) is not None:
+                self._uploaded.move_to_end(digest)
+
+        if self._pool is None:
+            self._upload(bytes, target_url, source)
+            if digest is not None and source is None:
+                self._remember(digest, target_url, None)
+            return
+
+        size = len(bytes)
+        with self._condition:
+            # Always let one upload through, even if it's bigger than the limit
+            while self._in_flight and self._in_flight + size > self.max_in_flight:
+                self._condition.wait()
+            self._in_flight += size
+            self._pending += 1
+        future = self._pool.submit(self._upload_in_background, bytes, target_url, path, size, source, digest)
+        if digest is not None and source is None:
+            self._remember(digest, target_url, future)
 
     def export_file(self, file, path):
+        if self._pool is not None:
+            # The caller may close the file once this returns
+            self.export_bytes(file.read(), path)
+            return
+
+        self.s3.upload_fileobj(file, self._get_target_path(path))
+
+    @contextlib.contextmanager
+    def open_writer(self, path: str) -> Iterator[BinaryIO]:
+        """
+        Streams into a multipart upload from the calling thread, a part is sent
+        whenever enough is written. Unlike background uploads, errors are raised.
+        """
+        writer = MultipartUploadWriter(self.s3, self._get_target_path(path))
+        try:
+            yield writer
+        except BaseException:
+            writer.abort()
+            raise
+        writer.complete()
+
+    def flush(self):
+        with self._condition:
+            while self._pending:
+                self._condition.wait()
+
+    def close(self):
+        self.flush()
+        if self._pool is not None:
+            self._pool.shutdown()
+
+    @property
+    def failed(self) -> Dict[str, BaseException]:
+        return self._failed
+
+    def _upload(self, data, target_url: S3Url, source: Optional[Tuple[S3Url, Optional[Future]]] = None):
+        if source is not None:
+            from botocore.exceptions import ClientError
+
+            source_url, source_future = source
+            # Uploads run in submission order, so the source is already in progress
+            if source_future is None or source_future.result():
+                try:
+                    with stats.timer('s3.copy'):
+                        self.s3.call(
+                            self.s3.client.copy_object,
+                            Bucket=target_url.bucket,
+                            Key=target_url.prefix,
+                            CopySource={'Bucket': source_url.bucket, 'Key': source_url.prefix}
+                        )
+                    stats.count('s3.copies')
+                    return
+                except ClientError:
+                    # Fall back to uploading the data
+                    pass
+
+        with stats.timer('s3.upload'):
+            if len(data) < self.s3.connection.multipart_threshold:
+                # A single PUT, the transfer manager costs extra round trips on small objects
+                self.s3.call(self.s3.client.put_object, Bucket=target_url.bucket, Key=target_url.prefix, Body=data)
+            else:
+                with io.BytesIO(data) as input_file:
+                    self.s3.upload_fileobj(input_file, target_url)
+        stats.count('s3.upload.bytes', len(data))
+
+    def _remember(self, digest: bytes, target_url: S3Url, future: Optional[Future]):
+        with self._condition:
+            if future is not None and future.done():
+                if not future.result():
+                    return
+                future = None
+            self._uploaded[digest] = (target_url, future)
+            self._uploaded_keys[str(target_url)] = digest
+            while len(self._uploaded) > DEDUPLICATE_ENTRIES:
+                _, (evicted_url, _) = self._uploaded.popitem(last=False)
+                self._uploaded_keys.pop(str(evicted_url), None)
+
+    def _forget(self, key: str):
+        digest = self._uploaded_keys.pop(key, None)
+        if digest is not None:
+            self._uploaded.pop(digest, None)
+
+    def _upload_in_background(self, data, target_url: S3Url, path: str, size: int, source, digest: Optional[bytes]) -> bool:
+        try:
+            self._upload(data, target_url, source)
+        except Exception as e:
+            with self._condition:
+                self._failed[path] = e
+                if digest is not None and self._uploaded_keys.get(str(target_url)) == digest:
+                    self._forget(str(target_url))
+            return False
+        else:
+            with self._condition:
+                self._failed.pop(path, None)
+                # Done, later copies only need the key
+                entry = self._uploaded.get(digest) if digest is not None else None
+                if entry is not None and str(entry[0]) == str(target_url):
+                    self._uploaded[digest] = (target_url, None)
+            return True
+        finally:
+            with self._condition:
+                self._in_flight -= size
+                self._pending -= 1
+                self._condition.notify_all()
+
+    def read_bytes(self, path: str) -> Optional[bytes]:
         target_url = self._get_target_path(path)
-        object = self.s3.url_to_object(target_url)
-        object.upload_fileobj(file)
+        try:
+            return self.s3.get_object_bytes(target_url.bucket, target_url.prefix)
+        except self.s3.client.exceptions.NoSuchKey:
+            return None
     
     def _get_target_path(self,path) -> S3Url:
         return self.base_url / path
@@ -40,6 +227,7 @@ class FolderExporter(Exporter):
 
         with open(path, 'wb') as output_file:
             output_file.write(bytes)
+        stats.count('folder.write.bytes', len(bytes))
 
     def export_file(self, input_file, path):
         path = self.base_path / path
@@ -47,6 +235,37 @@ class FolderExporter(Exporter):
         
         with open(path, 'w', encoding='utf-8') as output_file:
             output_file.write(input_file.read())
+
+    @contextlib.contextmanager
+    def open_writer(self, path: str) -> Iterator[BinaryIO]:
+        # Written next to the target and moved over it once complete, so the
+        # previous file stays in place until then and a failed run leaves it intact
+        path = self.base_path / path
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+        output_file = tempfile.NamedTemporaryFile(
+            'wb', buffering=1024 ** 2, dir=path.parent, prefix=f".{path.name}.", suffix='.tmp', delete=False
+        )
+        try:
+            with output_file:
+                yield output_file
+                size = output_file.tell()
+            try:
+                mode = path.stat().st_mode & 0o7777
+            except FileNotFoundError:
+                mode = DEFAULT_FILE_MODE
+            os.chmod(output_file.name, mode)
+            os.replace(output_file.name, path)
+        except BaseException:
+            os.unlink(output_file.name)
+            raise
+        stats.count('folder.write.bytes', size)
+
+    def read_bytes(self, path: str) -> Optional[bytes]:
+        path = self._get_target_path(path)
+        if not path.is_file():
+            return None
+        return path.read_bytes()
     
     def _get_target_path(self, path) -> Path:
         return self.base_path / path
@@ -0,0 +1,151 @@
+import io
+import json
+import time
+import hashlib
+import contextlib
+from typing import BinaryIO, Dict, Iterator, List, Optional
+
+from .base import Exporter
+
+
+class ManifestExporter(Exporter):
+    """
+    Wraps an exporter and keeps a manifest of every written file and its content
+    hash, grouped by the task that produced it.
+
+    A manifest left by a previous run lets builders skip tasks whose fingerprint
+    hasn't changed, and files whose content is identical aren't written again.
+    The manifest is checkpointed while exporting, so an interrupted run can be resumed.
+    """
+    filename = '.export-manifest.json'
+
+    def __init__(self, exporter: Exporter, checkpoint_interval: float = 60.0, filename: Optional[str] = None):
+        self.exporter = exporter
+        self.checkpoint_interval = checkpoint_interval
+        # Runs sharing the exporter's target, like the shards of an export, keep their own
+        if filename is not None:
+            self.filename = filename
+
+        previous = exporter.read_bytes(self.filename)
+        previous = json.loads(previous) if previous else {}
+        self.previous_tasks: Dict[str, dict] = previous.get('tasks', {})
+        self.previous_files: Dict[str, str] = previous.get('files', {})
+
+        self.tasks: Dict[str, dict] = {}
+        self.files: Dict[str, str] = {}
+
+        self._task_files: Optional[List[str]] = None
+        self._last_checkpoint = time.monotonic()
+
+    def is_current(self, key: str, fingerprint: str) -> bool:
+        entry = self.previous_tasks.get(key)
+        return entry is not None and entry['fingerprint'] == fingerprint
+
+    def keep_task(self, key: str):
+        entry = self.previous_tasks[key]
+        self.tasks[key] = entry
+        for path in entry['files']:
+            if path in self.previous_files:
+                self.files[path] = self.previous_files[path]
+
+    def start_task(self, key: str):
+        self._task_files = []
+
+    def finish_task(self, key: str, fingerprint: str):
+        self.tasks[key] = {
+            'fingerprint': fingerprint,
+            'files': self._task_files
+        }
+        self._task_files = None
+
+        if time.monotonic() - self._last_checkpoint >= self.checkpoint_interval:
+            self.save()
+
+    def save(self, complete: bool = False):
+        """
+        Writes the manifest. Until the run is complete, entries of the previous
+        manifest that weren't reached yet are kept, so a resumed run can skip them.
+        """
+        # Only claim files that actually made it to the output
+        self.exporter.flush()
+        failed = self.exporter.failed
+
+        tasks, files = self.tasks, self.files
+        if not complete:
+            tasks = {**self.previous_tasks, **self.tasks}
+            files = {**self.previous_files, **self.files}
+        if failed:
+            # Tasks with a failed file are exported again on the next run
+            files = {path: digest for path, digest in files.items() if path not in failed}
+            tasks = {
+                key: entry for key, entry in tasks.items()
+                if not any(path in failed for path in entry['files'])
+            }
+
+        manifest = json.dumps({'tasks': tasks, 'files': files}, ensure_ascii=False)
+        self.exporter.export_bytes(manifest.encode('utf-8'), self.filename)
+        self.exporter.flush()
+        self._last_checkpoint = time.monotonic()
+
+    def export_bytes(self, bytes, path: str):
+        if self._record(bytes, path):
+            self.exporter.export_bytes(bytes, path)
+
+    def export_file(self, file, path: str):
+        content = file.read()
+        data = content.encode('utf-8') if isinstance(content, str) else content
+        if self._record(data, path):
+            file = io.StringIO(content) if isinstance(content, str) else io.BytesIO(content)
+            self.exporter.export_file(file, path)
+
+    @contextlib.contextmanager
+    def open_writer(self, path: str) -> Iterator[BinaryIO]:
+        # Streamed files are always written, they're hashed on the way through
+        with self.exporter.open_writer(path) as writer:
+            hashing = _HashingWriter(writer)
+            yield hashing
+        self.files[path] = hashing.digest.hexdigest()
+        if self._task_files is not None:
+            self._task_files.append(path)
+
+    def read_bytes(self, path: str) -> Optional[bytes]:
+        return self.exporter.read_bytes(path)
+
+    def flush(self):
+        self.exporter.flush()
+
+    def close(self):
+        self.exporter.close()
+
+    def abort(self):
+        self.exporter.abort()
+
+    @property
+    def failed(self) -> Dict[str, BaseException]:
+        return self.exporter.failed
+
+    def _record(self, data, path: str) -> bool:
+        """Records the file, returns whether it has to be written."""
+        digest = hashlib.sha256(data).hexdigest()
+        self.files[path] = digest
+        if self._task_files is not None:
+            self._task_files.append(path)
+        return self.previous_files.get(path) != digest
+
+
+class _HashingWriter(io.RawIOBase):
+    def __init__(self, writer: BinaryIO):
+        self.writer = writer
+        self.digest = hashlib.sha256()
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self.digest.update(data)
+        return self.writer.write(data)
+
+
+__all__ = [
+    "ManifestExporter"
+]
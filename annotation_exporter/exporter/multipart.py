@@ -0,0 +1,96 @@
+import io
+from typing import List
+
+from annotation_exporter.s3 import S3Url, S3Context
+from annotation_exporter.stats import stats
+
+
+# S3 requires every part but the last one to be at least 5 MiB
+PART_SIZE = 16 * 1024 ** 2
+
+
+class MultipartUploadWriter(io.RawIOBase):
+    """
+    Write-only file object streaming into an S3 multipart upload. The object
+    only appears once `complete` is called, closing the writer without it,
+    including when it's garbage collected, aborts the upload.
+    """
+    def __init__(self, s3: S3Context, target_url: S3Url, part_size: int = PART_SIZE):
+        self.s3 = s3
+        self.target_url = target_url
+        self.part_size = part_size
+
+        self._buffer = bytearray()
+        self._parts: List[dict] = []
+        self._completed = False
+        self._upload_id = s3.call(
+            s3.client.create_multipart_upload,
+            Bucket=target_url.bucket, Key=target_url.prefix
+        )['UploadId']
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self._buffer += data
+        while len(self._buffer) >= self.part_size:
+            self._upload_part(self._buffer[:self.part_size])
+            del self._buffer[:self.part_size]
+        return len(data)
+
+    def complete(self):
+        """Uploads what's left and publishes the object."""
+        if self.closed:
+            raise ValueError("Upload is already closed")
+        try:
+            if self._buffer or not self._parts:
+                self._upload_part(self._buffer)
+            self.s3.call(
+                self.s3.client.complete_multipart_upload,
+                Bucket=self.target_url.bucket,
+                Key=self.target_url.prefix,
+                UploadId=self._upload_id,
+                MultipartUpload={'Parts': self._parts}
+            )
+        except BaseException:
+            self.abort()
+            raise
+        self._completed = True
+        super().close()
+
+    def close(self):
+        # An upload that wasn't completed is incomplete, it mustn't replace the target
+        if not self.closed and not self._completed:
+            self.abort()
+        super().close()
+
+    def abort(self):
+        """Drops the upload, nothing is written to the target."""
+        if self.closed:
+            return
+        try:
+            self.s3.call(
+                self.s3.client.abort_multipart_upload,
+                Bucket=self.target_url.bucket, Key=self.target_url.prefix, UploadId=self._upload_id
+            )
+        finally:
+            super().close()
+
+    def _upload_part(self, data):
+        number = len(self._parts) + 1
+        with stats.timer('s3.upload'):
+            response = self.s3.call(
+                self.s3.client.upload_part,
+                Bucket=self.target_url.bucket,
+                Key=self.target_url.prefix,
+                UploadId=self._upload_id,
+                PartNumber=number,
+                Body=bytes(data)
+            )
+        stats.count('s3.upload.bytes', len(data))
+        self._parts.append({'PartNumber': number, 'ETag': response['ETag']})
+
+
+__all__ = [
+    "MultipartUploadWriter"
+]
@@ -0,0 +1,151 @@
+import io
+import json
+import tarfile
+from pathlib import Path
+from typing import List, Optional
+
+from annotation_exporter.s3 import S3Url, S3Context
+from annotation_exporter.stats import stats
+
+from .base import Exporter
+from .multipart import MultipartUploadWriter
+
+
+class ShardExporter(Exporter):
+    """
+    Packs exported files into size-bounded tar shards, WebDataset-style, written
+    to a local folder or streamed to S3 with multipart uploads.
+
+    Every shard `shard-000000.tar` gets a `shard-000000.json` index with the data
+    offset and size of each member, so a single file can be read with one ranged
+    read. `index.json` lists all shards once the exporter is closed.
+
+    Exporters writing to the same base, like the runs of a sharded export,
+    need their own `prefix` and `index_name`.
+    """
+    # Shards are append-only, there's nothing to skip or rewrite in place
+    supports_manifest = False
+
+    def __init__(
+        self,
+        base: str | Path | S3Url,
+        s3: Optional[S3Context] = None,
+        max_shard_size: int = 512 * 1024 ** 2,
+        prefix: str = 'shard',
+        index_name: str = 'index.json'
+    ):
+        if isinstance(base, str) and S3Url.is_s3_url(base):
+            base = S3Url(base)
+        if isinstance(base, S3Url) and s3 is None:
+            raise ValueError("S3 context is required to export shards to s3")
+        if not isinstance(base, S3Url):
+            base = Path(base).resolve()
+            base.mkdir(parents=True, exist_ok=True)
+
+        self.base = base
+        self.s3 = s3
+        self.max_shard_size = max_shard_size
+        self.prefix = prefix
+        self.index_name = index_name
+
+        self.shards: List[dict] = []
+        self._file = None
+        self._tar: Optional[tarfile.TarFile] = None
+        self._members: List[dict] = []
+
+    def export_bytes(self, bytes, path: str):
+        if self._tar is None:
+            self._open_shard()
+
+        info = tarfile.TarInfo(path)
+        info.size = len(bytes)
+        info.mode = 0o644
+        try:
+            self._tar.addfile(info, io.BytesIO(bytes))
+        except BaseException:
+            self.abort()
+            raise
+        stats.count('shards.write.bytes', info.size)
+
+        # Data is padded to whole blocks and sits right before the tar's current offset
+        padded_size = -(-info.size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+        self._members.append({
+            'name': path,
+            'offset': self._tar.offset - padded_size,
+            'size': info.size
+        })
+
+        if self._tar.offset >= self.max_shard_size:
+            self._close_shard()
+
+    def export_file(self, file, path: str):
+        content = file.read()
+        self.export_bytes(content.encode('utf-8') if isinstance(content, str) else content, path)
+
+    def read_bytes(self, path: str) -> Optional[bytes]:
+        return None
+
+    def close(self):
+        self._close_shard()
+        index = {'shards': self.shards}
+        self._write_small(self.index_name, json.dumps(index, ensure_ascii=False).encode('utf-8'))
+
+    def _shard_name(self) -> str:
+        return f"{self.prefix}-{len(self.shards):06d}"
+
+    def _open_shard(self):
+        name = f"{self._shard_name()}.tar"
+        if isinstance(self.base, S3Url):
+            self._file = MultipartUploadWriter(self.s3, self.base / name)
+        else:
+            self._file = open(self.base / name, 'wb')
+
+        # Stream mode never seeks, as required by multipart uploads
+        self._tar = tarfile.open(fileobj=self._file, mode='w|', format=tarfile.PAX_FORMAT)
+        self._members = []
+
+    def abort(self):
+        """Drops the shard being written, shards already closed are kept."""
+        if self._tar is None:
+            return
+        file = self._file
+        self._tar, self._file = None, None
+        if isinstance(file, MultipartUploadWriter):
+            file.abort()
+        else:
+            file.close()
+            Path(file.name).unlink(missing_ok=True)
+
+    def _close_shard(self):
+        if self._tar is None:
+            return
+
+        name = self._shard_name()
+        try:
+            self._tar.close()
+            if isinstance(self._file, MultipartUploadWriter):
+                self._file.complete()
+            else:
+                self._file.close()
+        except BaseException:
+            self.abort()
+            raise
+        self._tar, self._file = None, None
+
+        index = {'shard': f"{name}.tar", 'members': self._members}
+        self._write_small(f"{name}.json", json.dumps(index, ensure_ascii=False).encode('utf-8'))
+        self.shards.append({'shard': f"{name}.tar", 'index': f"{name}.json", 'count': len(self._members)})
+
+    def _write_small(self, name: str, data: bytes):
+        if isinstance(self.base, S3Url):
+            target_url = self.base / name
+            with stats.timer('s3.upload'):
+                self.s3.call(self.s3.client.put_object, Bucket=target_url.bucket, Key=target_url.prefix, Body=data)
+            stats.count('s3.upload.bytes', len(data))
+        else:
+            (self.base / name).write_bytes(data)
+
+
+__all__ = [
+    "ShardExporter"
+]
@@ -1,67 +1,319 @@
-from environs import env
-env.read_env()
-
+import sys
+import json
 import argparse
+import importlib
+import itertools
 from pathlib import Path
-from typing import List
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
 
 from .s3 import *
-from .annotations import *
+from .cache import *
+from .stats import *
 from .exporter import *
-from .builder import *
+from .builder import builder_names, get_builder
 
 
-def main():
-    # 0. Create parser
-    parser = argparse.ArgumentParser(
-        prog='anno-exporter',
-        description='Converts Label Studio annotations to a dataset'
-    )
-    parser.add_argument("--from", nargs=2, metavar=("TYPE", "VALUE"), action='append')
-    parser.add_argument('--to', nargs=2, metavar=("TYPE", "VALUE"), action='append')
-    parser.add_argument('--data', choices=builder_names, default='trocr')
-    args = parser.parse_args()
+def parse_data(value: str) -> List[str]:
+    names = value.split(',')
+    for name in names:
+        if name not in builder_names:
+            raise argparse.ArgumentTypeError(f"invalid choice: {name!r} (choose from {', '.join(builder_names)})")
+    if len(set(names)) != len(names):
+        raise argparse.ArgumentTypeError('a dataset type is listed twice')
+    return names
 
-    if not getattr(args, 'from'):
-        parser.error('No data sources provided.')
+
+def positive_int(value: str) -> int:
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"{value} is not a positive number")
+    return number
+
+
+def positive_float(value: str) -> float:
+    number = float(value)
+    if not number > 0:
+        raise argparse.ArgumentTypeError(f"{value} is not a positive number")
+    return number
+
+
+def jpeg_quality(value: str) -> int:
+    quality = int(value)
+    if not 0 <= quality <= 100:
+        raise argparse.ArgumentTypeError(f"{value} is not between 0 and 100")
+    return quality
+
+
+def output_for(value: str, name: str) -> str:
+    # Each dataset of a multi-dataset run goes to its own folder or prefix
+    if value.startswith('s3://'):
+        return f"{value.rstrip('/')}/{name}"
+    return str(Path(value) / name)
+
+
+def check_outputs(parser: argparse.ArgumentParser, args: argparse.Namespace):
     if not args.to:
         parser.error('No data outputs provided')
+    for output_type, _ in args.to:
+        if ':' in output_type and output_type.partition(':')[0] not in args.data:
+            parser.error(f'Output {output_type} is for a dataset type that is not in --data')
+    for name in args.data:
+        if not any(output_type.rpartition(':')[0] in ('', name) for output_type, _ in args.to):
+            parser.error(f'No data outputs provided for {name}')
 
-    # 1. Connect to S3
+
+def iter_outputs(args: argparse.Namespace) -> Iterator[Tuple[str, str, str]]:
+    """(dataset type, output type, value) of every exporter the `--to` outputs make, in `--data` order."""
+    for name in args.data:
+        for output_type, value in args.to:
+            data_type, _, output_type = output_type.rpartition(':')
+            if data_type and data_type != name:
+                continue
+            if not data_type and len(args.data) > 1:
+                value = output_for(value, name)
+            yield name, output_type, value
+
+
+def create_s3_context(env, cache: Optional[DiskCache] = None, **connection) -> S3Context:
     s3_connection = S3ConnectionConfig(
         region=env('AWS_REGION_NAME'),
-        endpoint=env('AWS_ENDPOINT_URL')
+        endpoint=env('AWS_ENDPOINT_URL'),
+        **connection
     )
     s3_credentials = S3Credentials(
         access_key_id=env('AWS_ACCESS_KEY_ID'),
         secret_access_key=env('AWS_SECRET_ACCESS_KEY'),
         session_token=env('AWS_SESSION_TOKEN')
     )
-    s3_context = S3Context(s3_connection, s3_credentials)
+    return S3Context(s3_connection, s3_credentials, cache=cache)
+
+
+def create_outputs(
+    args: argparse.Namespace,
+    s3_context: S3Context,
+    shard=None,
+    resume: bool = False
+) -> Tuple[List[Tuple[str, str, Exporter]], List[List[Exporter]]]:
+    """
+    Exporters of every `--to` output as (dataset type, value, exporter), and
+    the exporters of each dataset type in `--data` order.
+    """
+    outputs: List[Tuple[str, str, Exporter]] = []
+    targets: Dict[str, List[Exporter]] = {name: [] for name in args.data}
+    for name, output_type, value in iter_outputs(args):
+        match output_type:
+            case 's3':
+                exporter = S3Exporter(s3_context, value, workers=args.workers)
+            case 'folder':
+                exporter = FolderExporter(Path(value))
+            case 'shards':
+                names = {}
+                if shard is not None:
+                    # Shards of the export write tar shards side by side
+                    names = dict(prefix=shard.file_name('shard'), index_name=shard.file_name('index.json'))
+                exporter = ShardExporter(value, s3_context, max_shard_size=args.shard_max_size * 1024 ** 2, **names)
+            case _:
+                raise ValueError(f'Unknown data output {output_type}')
+        if resume and exporter.supports_manifest:
+            filename = shard.file_name(ManifestExporter.filename) if shard is not None else None
+            exporter = ManifestExporter(exporter, filename=filename)
+        targets[name].append(exporter)
+        outputs.append((name, value, exporter))
+    return outputs, list(targets.values())
+
+
+def close_outputs(outputs: List[Tuple[str, str, Exporter]]) -> bool:
+    """Waits for background uploads, reports what didn't make it and returns whether anything failed."""
+    failed = False
+    for _, value, exporter in outputs:
+        exporter.close()
+        for path, error in exporter.failed.items():
+            print(f"Failed to export {path} to {value}: {error}", file=sys.stderr)
+            failed = True
+    return failed
+
+
+def merge(argv: List[str]):
+    parser = argparse.ArgumentParser(
+        prog='anno-exporter merge',
+        description='Combines the dataset files every shard of a sharded export wrote, like data.csv, once all shards are done'
+    )
+    parser.add_argument('--to', nargs=2, metavar=("TYPE", "VALUE"), action='append',
+                        help='outputs the shards exported to, as given to them')
+    parser.add_argument('--data', type=parse_data, default=['trocr'], metavar='TYPE[,TYPE...]',
+                        help='dataset types the shards built')
+    parser.add_argument('--shards', type=positive_int, required=True, metavar='N',
+                        help='number of shards the export was split into')
+    parser.add_argument('--workers', type=positive_int, default=8,
+                        help='number of threads uploading to S3')
+    args = parser.parse_args(argv)
+
+    check_outputs(parser, args)
+    for output_type, _ in args.to:
+        if output_type.rpartition(':')[2] == 'shards':
+            parser.error("shards outputs can't be merged, every shard lists its own files in index.K-of-N.json")
+    if args.shards < 1:
+        parser.error('--shards must be at least 1')
+
+    from environs import env
+    env.read_env()
+    s3_context = create_s3_context(env)
+
+    outputs, targets = create_outputs(args, s3_context)
+    failed = False
+    for name, exporters in zip(args.data, targets):
+        try:
+            get_builder(name)(s3_context).merge_shards(args.shards, exporters)
+        except (FileNotFoundError, ValueError) as e:
+            print(f"Can't merge {name}: {e}", file=sys.stderr)
+            failed = True
+    if close_outputs(outputs) or failed:
+        sys.exit(1)
+
+
+def main():
+    argv = sys.argv[1:]
+    if argv[:1] == ['merge']:
+        return merge(argv[1:])
+
+    # 0. Create parser
+    parser = argparse.ArgumentParser(
+        prog='anno-exporter',
+        description='Converts Label Studio annotations to a dataset',
+        epilog='anno-exporter merge combines the outputs of a --shard export, see anno-exporter merge --help'
+    )
+    parser.add_argument("--from", nargs=2, metavar=("TYPE", "VALUE"), action='append')
+    parser.add_argument('--to', nargs=2, metavar=("TYPE", "VALUE"), action='append',
+                        help='output, TYPE can be prefixed with a dataset type to only get that dataset, like yolo:folder')
+    parser.add_argument('--data', type=parse_data, default=['trocr'], metavar='TYPE[,TYPE...]',
+                        help=f"dataset types to build in one pass over the images, from {', '.join(builder_names)}")
+    parser.add_argument('--filter', action='append', default=[], metavar='KEY=VALUE',
+                        help='only export matching annotations: split=Validation, task=1,2,3 or since=2024-05-01, can be repeated')
+    parser.add_argument('--sample', type=float, default=None, metavar='FRACTION',
+                        help='only export this fraction of tasks, picked by their id')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seed of --sample, a different seed picks different tasks')
+    parser.add_argument('--shard', default=None, metavar='K/N',
+                        help='only export shard K of N, tasks are split by their id; run anno-exporter merge once every shard is done')
+    parser.add_argument('--workers', type=positive_int, default=8,
+                        help='number of threads downloading and decoding images')
+    parser.add_argument('--prefetch', type=int, default=None,
+                        help='how many images may be fetched ahead of processing (default: 2 * workers)')
+    parser.add_argument('--processes', type=positive_int, default=1,
+                        help='number of processes cropping, rotating and encoding images')
+    parser.add_argument('--max-size', '--imgsz', type=positive_int, default=None, metavar='PIXELS',
+                        help='longest side of exported images, larger ones are decoded at reduced scale and resized')
+    parser.add_argument('--jpeg-quality', type=jpeg_quality, default=100,
+                        help='JPEG quality of re-encoded yolo and craft images')
+    parser.add_argument('--line-height', type=positive_int, default=None, metavar='PIXELS',
+                        help='height trocr line images are scaled to')
+    parser.add_argument('--s3-pool-size', type=positive_int, default=None,
+                        help='S3 connections kept open (default: enough for every worker thread)')
+    parser.add_argument('--s3-chunk-size', type=positive_int, default=8,
+                        help='objects from this size on, in megabytes, are transferred in parts of this size')
+    parser.add_argument('--s3-max-attempts', type=positive_int, default=5,
+                        help='tries of an S3 request that is throttled or fails with a transient error')
+    parser.add_argument('--cache-dir', type=Path, default=None,
+                        help='directory for a persistent cache of downloaded images')
+    parser.add_argument('--cache-size', type=positive_float, default=10,
+                        help='cache size limit in gigabytes, least recently used images are evicted first')
+    parser.add_argument('--shard-max-size', type=positive_int, default=512,
+                        help='size limit of a single tar shard in megabytes')
+    parser.add_argument('--cache-annotations', type=Path, default=None, metavar='FILE',
+                        help='file to keep parsed annotations in, reused while the sources are unchanged')
+    parser.add_argument('--stats', type=Path, default=None, metavar='FILE',
+                        help='write counters and timings of the run to a JSON file')
+    parser.add_argument('--stats-hook', action='append', default=[], metavar='MODULE:CALLABLE',
+                        help='callable returning a StatsHook that receives every measurement, can be repeated')
+    parser.add_argument('--progress', action=argparse.BooleanOptionalAction, default=None,
+                        help='show a progress line (default: when stderr is a terminal)')
+    parser.add_argument('--resume', action='store_true',
+                        help='keep an export manifest in every output and skip tasks it shows as exported and unchanged')
+    args = parser.parse_args(argv)
+
+    if not getattr(args, 'from'):
+        parser.error('No data sources provided.')
+    check_outputs(parser, args)
+    if args.line_height is not None and 'trocr' not in args.data:
+        parser.error('--line-height only applies to trocr')
+
+    # Imported once arguments are valid, so --help and usage errors don't load numpy
+    from environs import env
+    from .annotations import (
+        Task,
+        AnnotationLoader,
+        S3AnnotationLoader,
+        ExportAnnotationLoader,
+        AnnotationCache,
+        TaskFilter,
+        Shard,
+        source_fingerprint
+    )
+    env.read_env()
+
+    shard = None
+    task_filter = None
+    try:
+        if args.shard is not None:
+            shard = Shard.parse(args.shard)
+        if args.filter or args.sample is not None or shard is not None:
+            task_filter = TaskFilter.parse(args.filter, sample=args.sample, seed=args.seed, shard=shard)
+    except ValueError as e:
+        parser.error(str(e))
+
+    stats.reset()
+    for hook in args.stats_hook:
+        module, _, factory = hook.partition(':')
+        stats.add_hook(getattr(importlib.import_module(module), factory)())
+    progress = None
+    if args.progress or (args.progress is None and sys.stderr.isatty()):
+        progress = ProgressHook(stats)
+        stats.add_hook(progress)
+
+    # 1. Connect to S3
+    # Prefetch, annotation loading and every exporter each run --workers threads,
+    # and untyped outputs make an exporter for every dataset type
+    exporter_count = sum(1 for _ in iter_outputs(args))
+    pool_size = args.s3_pool_size or max(10, args.workers * (2 + exporter_count))
+    chunk_size = args.s3_chunk_size * 1024 ** 2
+    cache = None
+    if args.cache_dir is not None:
+        cache = DiskCache(args.cache_dir, max_size=int(args.cache_size * 1024 ** 3))
+    s3_context = create_s3_context(
+        env,
+        cache=cache,
+        max_pool_connections=pool_size,
+        multipart_threshold=chunk_size,
+        multipart_chunksize=chunk_size,
+        max_attempts=args.s3_max_attempts
+    )
 
-    # 2. Get task annotations
-    tasks: List[Task] = []
+    # 2. Get task annotations, lazily so building starts with the first task
+    loaders: List[Tuple[AnnotationLoader, str]] = []
     for loader in (_from := getattr(args, 'from')):
         match loader:
             case ['s3', s3_url]:
-                loader_tasks = S3AnnotationLoader(s3_context).get_tasks(s3_url)
+                loaders.append((S3AnnotationLoader(s3_context, workers=args.workers, task_filter=task_filter), s3_url))
             case ['export', json_filepath]:
-                loader_tasks = ExportAnnotationLoader().get_tasks(json_filepath)
+                loaders.append((ExportAnnotationLoader(stream=True, task_filter=task_filter), json_filepath))
             case _:
                 raise ValueError(f'Unknown data source {_from[0]}')
-        tasks.extend(loader_tasks)
+    tasks: Iterable[Task] = itertools.chain.from_iterable(
+        loader.get_tasks(path) for loader, path in loaders
+    )
+    if args.cache_annotations is not None:
+        annotation_cache = AnnotationCache(args.cache_annotations)
+        source = source_fingerprint(loaders)
+        if source is None:
+            print("Annotation sources can't be fingerprinted, not caching them", file=sys.stderr)
+        elif (cached_tasks := annotation_cache.load(source)) is not None:
+            tasks = cached_tasks
+        else:
+            tasks = annotation_cache.write_through(source, tasks)
     
-    # 3. Prepare exporters
-    exporters: List[Exporter] = []
-    for output in (to := args.to):
-        match output:
-            case ['s3', s3_url]:
-                exporter = S3Exporter(s3_context, s3_url)
-            case ['folder', path]:
-                exporter = FolderExporter(Path(path))
-            case _:
-                raise ValueError(f'Unknown data output {to[0]}')
-        exporters.append(exporter)
+    # 3. Prepare exporters, for every dataset type
+    outputs, targets = create_outputs(args, s3_context, shard=shard, resume=args.resume)
+    exporters = [exporter for _, _, exporter in outputs]
 
     # 4. Pick an dataset builder and build
     # match args.data:
@@ -71,12 +323,44 @@ def main():
     #         builder = YoloBuilder(s3_context)
     #     case _:
     
-    builder_type = next((b for b in builders if b.name == args.data), None)
-    if builder_type is None:
-        raise ValueError(f'Unknown dataset type {args.data}')
-    
-    builder = builder_type(s3_context)
-    builder.build_dataset(tasks, exporters)
+    pipeline = dict(workers=args.workers, prefetch=args.prefetch, processes=args.processes)
+    builders = []
+    for name in args.data:
+        options = {}
+        if name == 'trocr' and args.line_height is not None:
+            options['line_height'] = args.line_height
+        builder_options = dict(max_size=args.max_size, jpeg_quality=args.jpeg_quality, shard=shard, **options)
+        if len(args.data) == 1:
+            builder_options.update(pipeline)
+        builders.append(get_builder(name)(s3_context, **builder_options))
+
+    if len(builders) == 1:
+        builder = builders[0]
+    else:
+        from .builder import MultiBuilder
+        builder = MultiBuilder(s3_context, builders, targets, **pipeline)
+    try:
+        builder.build_dataset(tasks, exporters)
+    except BaseException:
+        # Nothing half-written is published under its final name
+        for exporter in exporters:
+            exporter.abort()
+        raise
+
+    # 5. Wait for background uploads and report what didn't make it
+    failed = False
+    for task_id, error in builder.failed_tasks.items():
+        print(f"Failed to export task {task_id}: {error}", file=sys.stderr)
+        failed = True
+    if close_outputs(outputs):
+        failed = True
+
+    if progress is not None:
+        progress.close()
+    if args.stats is not None:
+        args.stats.write_text(json.dumps(stats.summary(), indent=2), encoding='utf-8')
+    if failed:
+        sys.exit(1)
     
 
 
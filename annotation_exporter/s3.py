@@ -1,18 +1,35 @@
 import io
 import re
+import threading
 import dataclasses
-from typing import Union
+from typing import Callable, Dict, Iterator, List, Optional, Tuple, TypeVar, Union
 
-import boto3
+from .cache import DiskCache
+from .stats import stats
+from .scheduler import IOScheduler
+
+
+T = TypeVar('T')
 
 
 S3_URL_PATTERN = re.compile("^s3://(?P<bucket>[^/\s]+)(?:/(?P<prefix>[^\s]*?(?P<item>[^/\s]+)/?)?)?$")
+# Characters that make a path need the full pattern to be joined
+_S3_PATH_SPECIAL = re.compile("\\s|/$")
 
 
 @dataclasses.dataclass
 class S3ConnectionConfig:
     region: str
     endpoint: str
+    # HTTP connections kept open, should cover every thread talking to S3 at once
+    max_pool_connections: int = 10
+    # Objects from this size on are transferred in parts of `multipart_chunksize`
+    multipart_threshold: int = 8 * 1024 ** 2
+    multipart_chunksize: int = 8 * 1024 ** 2
+    # Parts transferred at once for a single object
+    max_concurrency: int = 10
+    # Tries of a request that's throttled or fails with a transient error
+    max_attempts: int = 5
 
 
 @dataclasses.dataclass
@@ -23,41 +40,191 @@ class S3Credentials:
 
 
 class S3Context:
-    def __init__(self, connection: S3ConnectionConfig, credentials: S3Credentials):        
-        self.session = boto3.session.Session(    
-            aws_access_key_id=credentials.access_key_id,
-            aws_secret_access_key=credentials.secret_access_key,
-            aws_session_token=credentials.session_token
-        )
-        self.resource = self.session.resource(
-            service_name='s3',
-            region_name=connection.region,
-            endpoint_url=connection.endpoint
+    """
+    boto3 is imported and the session is created on first use, so runs
+    that never reach S3 don't pay for either.
+
+    Requests go through `scheduler`, shared by every thread: throttled and
+    transient failures are retried, and concurrency backs off while the
+    endpoint throttles. Use `call` for requests made on `client` directly.
+    """
+    def __init__(
+        self,
+        connection: S3ConnectionConfig,
+        credentials: S3Credentials,
+        cache: Optional[DiskCache] = None
+    ):
+        self.cache = cache
+        self.connection = connection
+        self.credentials = credentials
+        self.scheduler = IOScheduler(
+            max_concurrency=connection.max_pool_connections,
+            max_attempts=connection.max_attempts
         )
-    
+        self._session = None
+        self._lock = threading.Lock()
+        self._buckets: Dict[str, object] = {}
+
+    def _connect(self):
+        with self._lock:
+            if self._session is not None:
+                return
+            import boto3
+            from botocore.config import Config
+            from boto3.s3.transfer import TransferConfig
+
+            session = boto3.session.Session(
+                aws_access_key_id=self.credentials.access_key_id,
+                aws_secret_access_key=self.credentials.secret_access_key,
+                aws_session_token=self.credentials.session_token
+            )
+            self._resource = session.resource(
+                service_name='s3',
+                region_name=self.connection.region,
+                endpoint_url=self.connection.endpoint,
+                # Retries are up to the scheduler, which also adapts concurrency
+                config=Config(
+                    max_pool_connections=self.connection.max_pool_connections,
+                    retries={'mode': 'standard', 'total_max_attempts': 1}
+                )
+            )
+            # Low-level clients are thread-safe, unlike resources
+            self._client = self._resource.meta.client
+            self._transfer_config = TransferConfig(
+                multipart_threshold=self.connection.multipart_threshold,
+                multipart_chunksize=self.connection.multipart_chunksize,
+                max_concurrency=self.connection.max_concurrency
+            )
+            self._session = session
+
+    @property
+    def session(self):
+        if self._session is None:
+            self._connect()
+        return self._session
+
+    @property
+    def resource(self):
+        if self._session is None:
+            self._connect()
+        return self._resource
+
+    @property
+    def client(self):
+        if self._session is None:
+            self._connect()
+        return self._client
+
+    @property
+    def transfer_config(self):
+        if self._session is None:
+            self._connect()
+        return self._transfer_config
+
+    def call(self, function: Callable[..., T], *args, **kwargs) -> T:
+        """Runs an S3 request under the scheduler, retrying it when it's throttled."""
+        return self.scheduler.call(function, *args, **kwargs)
+
     def download_bytes(self, object) -> bytes:
-        if isinstance(object, str) and S3Url.is_s3_url(object):
-            object = self.url_to_object(object)
+        return bytes(self.download_buffer(object))
+
+    def download_buffer(self, object) -> bytes | memoryview:
+        """
+        Like `download_bytes`, but cache hits of large objects are returned
+        as a read-only memory map of the cached file instead of a copy.
+
+        Objects given by url take a single GET whatever their size, without
+        the transfer manager's HEAD request. Only boto3 objects are downloaded
+        through the transfer manager, in parts from the multipart threshold on.
+        """
+        bucket, key = self._locate(object)
+
+        if self.cache is not None:
+            data = self.call(self.cache.fetch, self.client, bucket, key)
+            return data if isinstance(data, bytes) else memoryview(data)
 
-        buffer = io.BytesIO()
-        object.download_fileobj(buffer)
-        return buffer.getvalue()
+        if isinstance(object, (str, S3Url)):
+            return self.get_object_bytes(bucket, key)
+
+        def download() -> bytes:
+            buffer = io.BytesIO()
+            object.download_fileobj(buffer, Config=self.transfer_config)
+            return buffer.getvalue()
+
+        with stats.timer('s3.download'):
+            data = self.call(download)
+        stats.count('s3.download.bytes', len(data))
+        return data
     
+    def get_object_bytes(self, bucket: str, key: str) -> bytes:
+        # A single GET, without the transfer manager's HEAD request
+        def get() -> bytes:
+            # The body is read inside the retried call, it can fail halfway too
+            return self.client.get_object(Bucket=bucket, Key=key)['Body'].read()
+
+        with stats.timer('s3.get'):
+            data = self.call(get)
+        stats.count('s3.download.bytes', len(data))
+        return data
+
+    def get_etag(self, object) -> str:
+        bucket, key = self._locate(object)
+        with stats.timer('s3.head'):
+            response = self.call(self.client.head_object, Bucket=bucket, Key=key)
+        return response['ETag']
+
     def download_file(self, object, path):
-        if isinstance(object, str) and S3Url.is_s3_url(object):
-            object = self.url_to_object(object)
+        bucket, key = self._locate(object)
+        self.call(self.client.download_file, bucket, key, str(path), Config=self.transfer_config)
+
+    def upload_fileobj(self, file, s3_url: Union[str, "S3Url"]):
+        if isinstance(s3_url, str):
+            s3_url = S3Url(s3_url)
+        start = file.tell()
 
-        object.download_file(path)
+        def upload():
+            # A retry sends the file from the start again
+            file.seek(start)
+            self.client.upload_fileobj(file, s3_url.bucket, s3_url.prefix, Config=self.transfer_config)
+
+        self.call(upload)
+
+    def list_keys(self, bucket: str, prefix: str) -> Iterator[List[dict]]:
+        """
+        Lists objects under a prefix a page at a time, each page requested
+        through the scheduler. Entries have at least 'Key', 'ETag' and 'Size'.
+        """
+        kwargs = {'Bucket': bucket, 'Prefix': prefix}
+        while True:
+            page = self.call(self.client.list_objects_v2, **kwargs)
+            yield page.get('Contents', [])
+            if not page.get('IsTruncated'):
+                return
+            kwargs['ContinuationToken'] = page['NextContinuationToken']
 
     def url_to_object(self, s3_url: Union[str, "S3Url"]):
         if isinstance(s3_url, str):
             s3_url = S3Url(s3_url)
-        return self.resource.Bucket(s3_url.bucket).Object(s3_url.prefix)
+        # Bucket handles are reused, creating one goes through the resource model
+        if (bucket := self._buckets.get(s3_url.bucket)) is None:
+            bucket = self._buckets[s3_url.bucket] = self.resource.Bucket(s3_url.bucket)
+        return bucket.Object(s3_url.prefix)
+
+    @staticmethod
+    def _locate(object) -> Tuple[str, str]:
+        """Bucket and key of an s3:// url, `S3Url` or boto3 Object."""
+        if isinstance(object, str):
+            object = S3Url(object)
+        if isinstance(object, S3Url):
+            return object.bucket, object.prefix
+        return object.bucket_name, object.key
 
 
 class S3Url:
+    __slots__ = ('bucket', 'prefix', 'item')
+
     def __init__(self, url: str):
-        if (match := re.match(S3_URL_PATTERN, url)) is None:
+        if (match := S3_URL_PATTERN.match(url)) is None:
             raise ValueError("Url is not s3")
         
         self.bucket = match.group("bucket")
@@ -65,14 +232,27 @@ class S3Url:
         self.item = match.group("item") or ""
 
     def __truediv__(self, to_append: str) -> "S3Url":
-        # jank
-        return S3Url(
-            f"s3://{self.bucket}/{'' if not self.prefix else self.prefix + '/'}{to_append}"
-    )
+        prefix = f"{self.prefix}/{to_append}" if self.prefix else to_append
+        if not to_append or _S3_PATH_SPECIAL.search(to_append):
+            # Let the pattern decide, and reject, anything unusual
+            return S3Url(f"s3://{self.bucket}/{prefix}")
+
+        # Joined without parsing the whole url again
+        url = S3Url.__new__(S3Url)
+        url.bucket = self.bucket
+        url.prefix = prefix
+        url.item = prefix.rpartition('/')[2]
+        return url
+
+    def __str__(self) -> str:
+        return f"s3://{self.bucket}/{self.prefix}"
+
+    def __repr__(self) -> str:
+        return f"S3Url({str(self)!r})"
 
     @staticmethod
     def is_s3_url(url: str) -> bool:
-        return re.match(S3_URL_PATTERN, url) is not None
+        return S3_URL_PATTERN.match(url) is not None
     
 
 __all__ = [
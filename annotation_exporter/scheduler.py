@@ -0,0 +1,131 @@
+import time
+import random
+import threading
+import contextlib
+from typing import Callable, Optional, TypeVar
+
+from .stats import stats
+
+
+T = TypeVar('T')
+
+# Error codes and HTTP statuses of an endpoint asking clients to slow down
+THROTTLING_CODES = frozenset([
+    'SlowDown', 'Throttling', 'ThrottlingException', 'RequestLimitExceeded',
+    'TooManyRequests', 'TooManyRequestsException', 'ServiceUnavailable', 'RequestThrottled'
+])
+THROTTLING_STATUSES = frozenset([429, 503])
+# Failures that are likely to go away on their own
+TRANSIENT_CODES = frozenset(['InternalError', 'RequestTimeout', 'RequestTimeoutException'])
+TRANSIENT_STATUSES = frozenset([500, 502, 504])
+
+
+def classify_error(error: BaseException) -> Optional[str]:
+    """
+    'throttled' for throttling responses, 'transient' for errors worth retrying,
+    None for everything else.
+    """
+    from botocore.exceptions import ClientError, ConnectionError, HTTPClientError, IncompleteReadError
+
+    if isinstance(error, ClientError):
+        code = error.response.get('Error', {}).get('Code')
+        status = error.response.get('ResponseMetadata', {}).get('HTTPStatusCode')
+        if code in THROTTLING_CODES or status in THROTTLING_STATUSES:
+            return 'throttled'
+        if code in TRANSIENT_CODES or status in TRANSIENT_STATUSES:
+            return 'transient'
+        return None
+    if isinstance(error, (ConnectionError, HTTPClientError, IncompleteReadError)):
+        return 'transient'
+    return None
+
+
+class IOScheduler:
+    """
+    Runs S3 requests from every thread under a shared concurrency limit, and
+    retries the ones that fail with throttling or transient errors.
+
+    The limit is adjusted AIMD-style: it's halved when the endpoint throttles
+    and grows by about one for every `limit` successful requests. Throttling of
+    requests sent before the last decrease doesn't count again, so a burst of
+    throttled requests halves the limit once. It starts at `max_concurrency`,
+    so unthrottled endpoints are never slowed down.
+    Retries wait a random time up to an exponentially growing delay.
+    """
+    def __init__(
+        self,
+        max_concurrency: int = 10,
+        min_concurrency: int = 1,
+        max_attempts: int = 5,
+        base_delay: float = 0.1,
+        max_delay: float = 20.0
+    ):
+        self.max_concurrency = max(1, max_concurrency)
+        self.min_concurrency = max(1, min(min_concurrency, self.max_concurrency))
+        self.max_attempts = max(1, max_attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+        self.limit = float(self.max_concurrency)
+        self._active = 0
+        self._last_decrease = -float('inf')
+        self._condition = threading.Condition()
+
+    def call(self, function: Callable[..., T], *args, **kwargs) -> T:
+        attempt = 1
+        while True:
+            with self._slot() as started:
+                try:
+                    result = function(*args, **kwargs)
+                except Exception as e:
+                    kind = classify_error(e)
+                    if kind is None:
+                        raise
+                    if kind == 'throttled':
+                        stats.count('s3.throttled')
+                        self._decrease(started)
+                    if attempt >= self.max_attempts:
+                        stats.count('s3.failed')
+                        raise
+                else:
+                    self._increase()
+                    return result
+
+            stats.count('s3.retries')
+            delay = min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+            time.sleep(random.uniform(0, delay))
+            attempt += 1
+
+    @contextlib.contextmanager
+    def _slot(self):
+        with self._condition:
+            while self._active >= int(self.limit):
+                self._condition.wait()
+            self._active += 1
+        try:
+            yield time.monotonic()
+        finally:
+            with self._condition:
+                self._active -= 1
+                self._condition.notify()
+
+    def _increase(self):
+        with self._condition:
+            if self.limit < self.max_concurrency:
+                previous = int(self.limit)
+                self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+                if int(self.limit) > previous:
+                    self._condition.notify()
+
+    def _decrease(self, started: float):
+        with self._condition:
+            if started < self._last_decrease:
+                return
+            self._last_decrease = time.monotonic()
+            self.limit = max(self.min_concurrency, self.limit / 2)
+
+
+__all__ = [
+    'IOScheduler',
+    'classify_error'
+]
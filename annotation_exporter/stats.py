@@ -0,0 +1,187 @@
+import sys
+import math
+import time
+import bisect
+import threading
+import contextlib
+from typing import Dict, List, TextIO, Tuple
+
+
+# Upper bounds of timing histogram buckets in seconds, doubling from 0.1 ms to about 100 s
+BUCKETS = [0.0001 * 2 ** i for i in range(21)]
+
+
+class StatsHook:
+    """
+    Receives every measurement as it's recorded. Subclass it to forward them
+    to a metrics backend. Hooks are called from whichever thread records, so
+    they must be thread-safe.
+    """
+    def count(self, name: str, value: float):
+        pass
+
+    def observe(self, name: str, seconds: float):
+        pass
+
+
+class Histogram:
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = math.inf
+        self.max = 0.0
+        self.buckets = [0] * (len(BUCKETS) + 1)
+
+    def add(self, seconds: float):
+        self.count += 1
+        self.total += seconds
+        self.min = min(self.min, seconds)
+        self.max = max(self.max, seconds)
+        self.buckets[bisect.bisect_left(BUCKETS, seconds)] += 1
+
+    def quantile(self, q: float) -> float:
+        # Upper bound of the bucket the quantile falls into
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS + [self.max], self.buckets):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def summary(self) -> dict:
+        return {
+            'count': self.count,
+            'total': self.total,
+            'mean': self.total / self.count if self.count else 0.0,
+            'min': self.min if self.count else 0.0,
+            'max': self.max,
+            'p50': self.quantile(0.5),
+            'p90': self.quantile(0.9),
+            'p99': self.quantile(0.99)
+        }
+
+
+class Stats:
+    """
+    Counters and timing histograms, shared by the whole run through `stats`.
+
+    With `buffered`, raw measurements are also kept until `drain`, so worker
+    processes can ship them back to be `merge`d into the main process.
+    """
+    def __init__(self):
+        self.hooks: List[StatsHook] = []
+        self.buffered = False
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.counters: Dict[str, float] = {}
+            self.timings: Dict[str, Histogram] = {}
+            self.started = time.monotonic()
+            self._buffer: List[Tuple[bool, str, float]] = []
+
+    def add_hook(self, hook: StatsHook):
+        self.hooks.append(hook)
+
+    def count(self, name: str, value: float = 1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+            if self.buffered:
+                self._buffer.append((False, name, value))
+        for hook in self.hooks:
+            hook.count(name, value)
+
+    def observe(self, name: str, seconds: float):
+        with self._lock:
+            if (histogram := self.timings.get(name)) is None:
+                histogram = self.timings[name] = Histogram()
+            histogram.add(seconds)
+            if self.buffered:
+                self._buffer.append((True, name, seconds))
+        for hook in self.hooks:
+            hook.observe(name, seconds)
+
+    @contextlib.contextmanager
+    def timer(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def drain(self) -> List[Tuple[bool, str, float]]:
+        with self._lock:
+            measurements, self._buffer = self._buffer, []
+        return measurements
+
+    def merge(self, measurements: List[Tuple[bool, str, float]]):
+        for is_timing, name, value in measurements:
+            if is_timing:
+                self.observe(name, value)
+            else:
+                self.count(name, value)
+
+    @property
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started
+
+    def summary(self) -> dict:
+        with self._lock:
+            counters = dict(self.counters)
+            timings = {name: histogram.summary() for name, histogram in self.timings.items()}
+        elapsed = self.elapsed
+        return {
+            'elapsed': elapsed,
+            'throughput': {
+                'tasks_per_second': counters.get('tasks.exported', 0) / elapsed,
+                'download_bytes_per_second': counters.get('s3.download.bytes', 0) / elapsed,
+                'upload_bytes_per_second': counters.get('s3.upload.bytes', 0) / elapsed
+            },
+            'counters': counters,
+            'timings': timings
+        }
+
+
+class ProgressHook(StatsHook):
+    """
+    Rewrites a progress line on `stream` as tasks get exported, at most every `interval` seconds.
+    """
+    def __init__(self, stats: "Stats", stream: TextIO = sys.stderr, interval: float = 1.0):
+        self.stats = stats
+        self.stream = stream
+        self.interval = interval
+        self._last = 0.0
+
+    def count(self, name: str, value: float):
+        if name != 'tasks.exported' or (now := time.monotonic()) - self._last < self.interval:
+            return
+        self._last = now
+        self.stream.write(f"\r{self.line()}")
+        self.stream.flush()
+
+    def line(self) -> str:
+        counters, elapsed = self.stats.counters, self.stats.elapsed
+        tasks = counters.get('tasks.exported', 0)
+        return (
+            f"{tasks:.0f} tasks ({tasks / elapsed:.1f}/s), "
+            f"{counters.get('regions.cropped', 0):.0f} regions, "
+            f"{counters.get('s3.download.bytes', 0) / 1024 ** 2:.1f} MB down, "
+            f"{counters.get('s3.upload.bytes', 0) / 1024 ** 2:.1f} MB up"
+        )
+
+    def close(self):
+        self.stream.write(f"\r{self.line()}\n")
+        self.stream.flush()
+
+
+stats = Stats()
+
+
+__all__ = [
+    'Stats',
+    'StatsHook',
+    'ProgressHook',
+    'stats'
+]
@@ -1,8 +1,37 @@
+from typing import Optional
+
 import cv2
 import numpy as np
 
 
+# Counter-clockwise quarter turns, like cv2.getRotationMatrix2D's positive angles
+_QUARTER_TURNS = {
+    1: cv2.ROTATE_90_COUNTERCLOCKWISE,
+    2: cv2.ROTATE_180,
+    3: cv2.ROTATE_90_CLOCKWISE,
+}
+
+
+def quarter_turns(angle: float) -> Optional[int]:
+    """
+    Counter-clockwise quarter turns in `angle` degrees, from 0 to 3,
+    None if it isn't a multiple of 90.
+    """
+    turns = angle / 90
+    if turns != round(turns):
+        return None
+    return int(round(turns)) % 4
+
+
 def rotate_image(image: cv2.Mat, angle: float) -> cv2.Mat:
+    """
+    Rotates counter-clockwise by `angle` degrees. Multiples of 90 are exact
+    transposes, and the sides swap so nothing is clipped. Other angles are
+    interpolated and keep the original canvas.
+    """
+    if (turns := quarter_turns(angle)) is not None:
+        return image if turns == 0 else cv2.rotate(image, _QUARTER_TURNS[turns])
+
     rotation_matrix = cv2.getRotationMatrix2D(
         np.array(image.shape[1::-1]) / 2,
         angle,
@@ -12,26 +41,128 @@ def rotate_image(image: cv2.Mat, angle: float) -> cv2.Mat:
     return image
 
 
+def resize_to_height(image: cv2.Mat, height: int) -> cv2.Mat:
+    """
+    Scales the image to `height` pixels, keeping its aspect ratio.
+    """
+    if image.size == 0 or image.shape[0] == height:
+        return image
+    width = max(1, round(image.shape[1] * height / image.shape[0]))
+    interpolation = cv2.INTER_AREA if height < image.shape[0] else cv2.INTER_CUBIC
+    return cv2.resize(image, (width, height), interpolation=interpolation)
+
+
+def crop_polygon(image: cv2.Mat, contour: np.ndarray, background: int = 255) -> cv2.Mat:
+    """
+    Crops the bounding rect of a polygon, filling pixels outside of it with `background`.
+    The mask only covers the bounding rect, not the whole image.
+    """
+    contour = np.asarray(contour, dtype=np.int32).reshape((-1, 1, 2))
+    x, y, w, h = cv2.boundingRect(contour)
+
+    # clip to the image, regions can slightly overflow its borders
+    x1, y1 = max(x, 0), max(y, 0)
+    x2, y2 = min(x + w, image.shape[1]), min(y + h, image.shape[0])
+    roi = image[y1:y2, x1:x2]
+    if roi.size == 0:
+        return roi.copy()
+
+    mask = np.zeros(roi.shape[:2], dtype=np.uint8)
+    cv2.fillPoly(mask, [contour], 255, offset=(-x1, -y1))
+
+    # composite in one masked copy onto the background
+    result = np.full_like(roi, background)
+    cv2.copyTo(roi, mask, result)
+    return result
+
+
+def crop_rotated_polygon(image: cv2.Mat, contour: np.ndarray, angle: float, background: int = 255) -> cv2.Mat:
+    """
+    `crop_polygon` followed by `rotate_image`, in a single affine warp from `image`
+    for angles that aren't multiples of 90. The crop is sized to the rotated
+    polygon, so its corners aren't clipped, and is filled with `background`
+    outside of it.
+    """
+    if quarter_turns(angle) is not None:
+        return rotate_image(crop_polygon(image, contour, background), angle)
+
+    contour = np.asarray(contour, dtype=np.float64).reshape((-1, 2))
+    # Rotation about the origin, then shifted so the rotated polygon starts at 0, 0
+    matrix = cv2.getRotationMatrix2D((0, 0), angle, 1.0)
+    rotated = contour @ matrix[:, :2].T
+    origin = np.floor(rotated.min(axis=0))
+    width, height = (np.ceil(rotated.max(axis=0)) - origin + 1).astype(int)
+    matrix[:, 2] = -origin
+
+    result = cv2.warpAffine(
+        image, matrix, (int(width), int(height)),
+        flags=cv2.INTER_CUBIC,
+        borderMode=cv2.BORDER_CONSTANT,
+        borderValue=(background,) * 4
+    )
+    mask = np.zeros(result.shape[:2], dtype=np.uint8)
+    cv2.fillPoly(mask, [np.round(rotated - origin).astype(np.int32)], 255)
+    return cv2.copyTo(result, mask, np.full_like(result, background))
+
+
 def rotate_point(x, y, angle, origin=(0, 0)) -> tuple[float, float]:
+    """
+    Rotates counter-clockwise by `angle` degrees as seen in an image, where y
+    points down, like `rotate_image`.
+    """
     angle = np.radians(angle)
+    cos, sin = np.cos(angle), np.sin(angle)
 
     x, y = x - origin[0], y - origin[1]
-    x = x * np.cos(angle) - y * np.sin(angle)
-    y = x * np.sin(angle) + y * np.cos(angle)
-    x, y = x + origin[0], y + origin[1]
-    return x, y
+    x, y = x * cos + y * sin, y * cos - x * sin
+    return x + origin[0], y + origin[1]
+
+
+def rotate_points(points: np.ndarray, angle, origin=(0, 0)) -> np.ndarray:
+    """
+    `rotate_point` over an (N, 2) array of points at once.
+    """
+    x, y = rotate_point(points[:, 0], points[:, 1], angle, origin)
+    return np.stack([x, y], axis=1)
 
 
 def rotate_ls_box(x1, y1, x2, y2, angle) -> tuple[float, float, float, float]:
-    p1 = rotate_point(x1, y1, angle, (50, 50))
-    p2 = rotate_point(x2, y2, angle, (50, 50))
+    return tuple(rotate_ls_boxes(np.array([[x1, y1, x2, y2]]), angle)[0].tolist())
+
+
+def rotate_ls_boxes(boxes: np.ndarray, angle) -> np.ndarray:
+    """
+    `rotate_ls_box` over an (N, 4) array of x1, y1, x2, y2 boxes at once.
+    Boxes are in percent of the image, so multiples of 90 map exactly onto the
+    image `rotate_image` turns, sides swapped.
+    """
+    boxes = np.asarray(boxes, dtype=np.float64).reshape((-1, 4))
+    x1, y1, x2, y2 = boxes.T
+    match quarter_turns(angle):
+        case 0:
+            return boxes.copy()
+        case 1:
+            return np.stack([y1, 100 - x2, y2, 100 - x1], axis=1)
+        case 2:
+            return np.stack([100 - x2, 100 - y2, 100 - x1, 100 - y1], axis=1)
+        case 3:
+            return np.stack([100 - y2, x1, 100 - y1, x2], axis=1)
+
+    p1 = rotate_points(boxes[:, :2], angle, (50, 50))
+    p2 = rotate_points(boxes[:, 2:], angle, (50, 50))
 
     # get it back to upper-left, lower-right point format
-    return min(p1[0], p2[0]), min(p1[1], p2[1]), max(p1[0], p2[0]), max(p1[1], p2[1])
+    return np.concatenate([np.minimum(p1, p2), np.maximum(p1, p2)], axis=1)
 
 
 __all__ = [
+    "crop_polygon",
+    "crop_rotated_polygon",
+    "quarter_turns",
     "rotate_image",
+    "resize_to_height",
     "rotate_point",
-    "rotate_ls_box"
+    "rotate_points",
+    "rotate_ls_box",
+    "rotate_ls_boxes"
 ]
@@ -0,0 +1,125 @@
+"""
+Checks that YOLO and CRAFT labels land on what they label in the exported
+image, for every quarter turn. Black boxes are drawn on a white page where the
+regions are, and each label box must cover its box and nothing outside it. The
+page is given both upright and as a JPEG stored sideways with an EXIF
+orientation, the way phone cameras save it.
+
+    python benchmarks/check_labels.py --width 800 --height 400
+"""
+import sys
+import json
+import struct
+import argparse
+import tempfile
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+from annotation_exporter.annotations import ExportAnnotationLoader
+from annotation_exporter.builder import SourceImage, get_builder
+
+
+# x, y, width, height in percent
+BOXES = [(10, 20, 30, 10), (55, 60, 35, 25)]
+ROTATIONS = [0, 90, 180, 270]
+
+
+def make_task(width: int, height: int, rotation: int) -> dict:
+    result = []
+    for r, (x, y, w, h) in enumerate(BOXES):
+        base = {'id': f'r{r}', 'original_width': width, 'original_height': height, 'image_rotation': rotation}
+        result.append({**base, 'type': 'rectangle', 'value': {'x': x, 'y': y, 'width': w, 'height': h}})
+        result.append({**base, 'type': 'textarea', 'value': {'text': [f'box {r}']}})
+    result.append({'id': 'c', 'type': 'choices', 'value': {'choices': ['Training']}})
+    return {
+        'id': rotation,
+        'data': {'ocr': f's3://images/{rotation}.jpg'},
+        'annotations': [{'id': 0, 'updated_at': None, 'result': result}]
+    }
+
+
+def make_page(width: int, height: int) -> np.ndarray:
+    page = np.full((height, width, 3), 255, dtype=np.uint8)
+    for x, y, w, h in BOXES:
+        cv2.rectangle(
+            page,
+            (round(x / 100 * width), round(y / 100 * height)),
+            (round((x + w) / 100 * width) - 1, round((y + h) / 100 * height) - 1),
+            (0, 0, 0), cv2.FILLED
+        )
+    return page
+
+
+def exif_sideways(page: np.ndarray) -> bytes:
+    """`page` as a JPEG stored a quarter turn left, with EXIF orientation 6 to show it upright."""
+    _, data = cv2.imencode('.jpg', np.rot90(page), [cv2.IMWRITE_JPEG_QUALITY, 95])
+    # big endian TIFF header with an IFD0 holding only the orientation
+    tiff = b'MM' + struct.pack('>HIHHHIHHI', 42, 8, 1, 0x0112, 3, 1, 6, 0, 0)
+    app1 = b'Exif\0\0' + tiff
+    data = data.tobytes()
+    return data[:2] + b'\xff\xe1' + struct.pack('>H', len(app1) + 2) + app1 + data[2:]
+
+
+def yolo_boxes(labels: bytes, width: int, height: int) -> np.ndarray:
+    rows = np.array([line.split()[1:] for line in labels.decode('utf-8').splitlines()], dtype=np.float64)
+    xc, yc, w, h = rows.T
+    return np.stack([(xc - w / 2) * width, (yc - h / 2) * height, (xc + w / 2) * width, (yc + h / 2) * height], axis=1)
+
+
+def craft_boxes(labels: bytes, width: int, height: int) -> np.ndarray:
+    rows = np.array([line.split(',')[:8] for line in labels.decode('utf-8').splitlines()], dtype=np.float64)
+    return np.stack([rows[:, 0], rows[:, 1], rows[:, 4], rows[:, 5]], axis=1)
+
+
+def check(image: np.ndarray, boxes: np.ndarray, tolerance: int = 2) -> list:
+    """Problems with the label boxes, empty when every dark pixel is labelled and every label is dark."""
+    dark = image.mean(axis=2) < 128
+    labelled = np.zeros_like(dark)
+    problems = []
+    for x1, y1, x2, y2 in np.round(boxes).astype(int):
+        labelled[max(y1 - tolerance, 0):y2 + tolerance, max(x1 - tolerance, 0):x2 + tolerance] = True
+        inner = dark[y1 + tolerance:y2 - tolerance, x1 + tolerance:x2 - tolerance]
+        if inner.size == 0 or inner.mean() < 0.99:
+            problems.append(f"label ({x1},{y1})-({x2},{y2}) isn't on a box")
+    if (dark & ~labelled).any():
+        ys, xs = np.nonzero(dark & ~labelled)
+        problems.append(f"box pixels around ({xs.min()},{ys.min()})-({xs.max()},{ys.max()}) aren't labelled")
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--width', type=int, default=800)
+    parser.add_argument('--height', type=int, default=400)
+    args = parser.parse_args()
+
+    page = make_page(args.width, args.height)
+    pages = [('upright', cv2.imencode('.png', page)[1].tobytes()), ('exif', exif_sideways(page))]
+    export = [make_task(args.width, args.height, rotation) for rotation in ROTATIONS]
+    with tempfile.TemporaryDirectory() as directory:
+        export_path = Path(directory) / 'export.json'
+        export_path.write_text(json.dumps(export), encoding='utf-8')
+        tasks = list(ExportAnnotationLoader().get_tasks(export_path))
+
+    failed = False
+    for name, labels_dir, parse in [('yolo', 'train/labels/', yolo_boxes), ('craft', 'ch4_training_localization_transcription_gt/gt_', craft_boxes)]:
+        builder = get_builder(name)(None)
+        for (page_name, data), task in ((page, task) for page in pages for task in tasks):
+            output = builder.render_task(0, task, SourceImage(data))
+            files = dict(output.files)
+            image_path = next(path for path in files if path.endswith('.jpg'))
+            # the stored pixels, as readers that ignore EXIF see them
+            image = cv2.imdecode(np.frombuffer(files[image_path], np.uint8), cv2.IMREAD_COLOR | cv2.IMREAD_IGNORE_ORIENTATION)
+            stem = Path(image_path).stem
+            labels = next(data for path, data in files.items() if path.startswith(labels_dir) and stem in path)
+
+            problems = check(image, parse(labels, image.shape[1], image.shape[0]))
+            print(f"{name} {page_name:<7} rotation {task.id:>3}: {'ok' if not problems else '; '.join(problems)}")
+            failed |= bool(problems)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
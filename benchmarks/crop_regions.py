@@ -0,0 +1,80 @@
+"""
+Micro-benchmark of TrOCR region cropping: the full-frame mask the builder used
+to allocate for every region against `crop_polygon`'s ROI-local mask.
+
+    python benchmarks/crop_regions.py --width 6000 --height 4000 --regions 200
+"""
+import time
+import argparse
+
+import cv2
+import numpy as np
+
+from annotation_exporter.utils import crop_polygon
+
+
+def crop_full_frame(image, contour):
+    image_height, image_width = image.shape[:2]
+    contour = contour.reshape((-1, 1, 2))
+    x, y, w, h = cv2.boundingRect(contour)
+
+    mask = np.zeros([image_height, image_width], dtype=np.uint8)
+    cv2.fillPoly(mask, [contour], 255)
+
+    mask = mask[y:y+h, x:x+w]
+    image_part = image[y:y+h, x:x+w]
+
+    text_part = cv2.bitwise_and(image_part, image_part, mask=mask)
+    white_bg = np.full_like(image_part, 255)
+    white_part = cv2.bitwise_and(white_bg, white_bg, mask=cv2.bitwise_not(mask))
+    return cv2.add(text_part, white_part)
+
+
+def random_lines(rng, width, height, count):
+    """Text-line-like quadrilaterals, a bit skewed"""
+    contours = []
+    for _ in range(count):
+        w, h = rng.integers(width // 10, width // 2), rng.integers(height // 80, height // 20)
+        x, y = rng.integers(0, width - w), rng.integers(0, height - h)
+        skew = rng.integers(-h // 2, h // 2 + 1)
+        contours.append(np.array(
+            [[x, y], [x + w, y + skew], [x + w, y + h + skew], [x, y + h]], dtype=np.int32
+        ).clip(0, [width - 1, height - 1]))
+    return contours
+
+
+def measure(crop, image, contours, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for contour in contours:
+            crop(image, contour)
+        best = min(best, time.perf_counter() - start)
+    return len(contours) / best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--width', type=int, default=6000)
+    parser.add_argument('--height', type=int, default=4000)
+    parser.add_argument('--regions', type=int, default=200)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    image = rng.integers(0, 256, (args.height, args.width, 3), dtype=np.uint8)
+    contours = random_lines(rng, args.width, args.height, args.regions)
+
+    for contour in contours:
+        if not np.array_equal(crop_full_frame(image, contour), crop_polygon(image, contour)):
+            raise AssertionError("ROI-local crop differs from the full-frame one")
+
+    before = measure(crop_full_frame, image, contours, args.repeat)
+    after = measure(crop_polygon, image, contours, args.repeat)
+    print(f"image {args.width}x{args.height}, {args.regions} regions")
+    print(f"full-frame mask: {before:10.1f} regions/s")
+    print(f"ROI-local mask:  {after:10.1f} regions/s ({after / before:.1f}x)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,170 @@
+"""
+In-process stand-in for S3, so benchmarks measure the exporter rather than the
+network. Implements the subset of the boto3 client the exporter calls, backed
+by a dict. An optional per-request latency models a remote endpoint, and an
+optional request limit one that throttles with 503 SlowDown. Conditional GETs
+answer 304 when the ETag matches, like S3 does for a revalidating cache.
+"""
+import io
+import time
+import hashlib
+import threading
+import itertools
+from typing import Dict, Optional, Tuple
+
+from annotation_exporter.s3 import S3Url, S3Context, S3ConnectionConfig, S3Credentials
+
+
+class NoSuchKey(Exception):
+    pass
+
+
+class _Exceptions:
+    NoSuchKey = NoSuchKey
+
+
+class LocalS3Client:
+    exceptions = _Exceptions
+
+    def __init__(self, latency: float = 0.0, throttle: Optional[int] = None):
+        self.latency = latency
+        # Requests in flight above this many are throttled
+        self.throttle = throttle
+        self.objects: Dict[Tuple[str, str], bytes] = {}
+        self.etags: Dict[Tuple[str, str], str] = {}
+        self.requests = 0
+        self.throttled = 0
+
+        self._lock = threading.Lock()
+        self._active = 0
+        self._uploads: Dict[str, Dict[int, bytes]] = {}
+        self._upload_ids = itertools.count()
+
+    def _request(self):
+        with self._lock:
+            self.requests += 1
+            self._active += 1
+            throttled = self.throttle is not None and self._active > self.throttle
+        try:
+            if self.latency:
+                time.sleep(self.latency)
+        finally:
+            with self._lock:
+                self._active -= 1
+        if throttled:
+            from botocore.exceptions import ClientError
+
+            with self._lock:
+                self.throttled += 1
+            raise ClientError(
+                {'Error': {'Code': 'SlowDown'}, 'ResponseMetadata': {'HTTPStatusCode': 503}},
+                'Request'
+            )
+
+    def _store(self, bucket: str, key: str, data: bytes):
+        with self._lock:
+            self.objects[(bucket, key)] = data
+            self.etags[(bucket, key)] = f'"{hashlib.md5(data).hexdigest()}"'
+
+    def put_object(self, Bucket: str, Key: str, Body):
+        self._request()
+        self._store(Bucket, Key, Body if isinstance(Body, bytes) else bytes(Body))
+        return {'ETag': self.etags[(Bucket, Key)]}
+
+    def upload_fileobj(self, Fileobj, Bucket: str, Key: str, Config=None):
+        self.put_object(Bucket=Bucket, Key=Key, Body=Fileobj.read())
+
+    def get_object(self, Bucket: str, Key: str, IfNoneMatch: Optional[str] = None):
+        self._request()
+        try:
+            data = self.objects[(Bucket, Key)]
+        except KeyError:
+            raise NoSuchKey(Key) from None
+        etag = self.etags[(Bucket, Key)]
+        if IfNoneMatch == etag:
+            from botocore.exceptions import ClientError
+
+            raise ClientError(
+                {'Error': {'Code': '304', 'Message': 'Not Modified'}, 'ResponseMetadata': {'HTTPStatusCode': 304}},
+                'GetObject'
+            )
+        return {'Body': io.BytesIO(data), 'ETag': etag, 'ContentLength': len(data)}
+
+    def head_object(self, Bucket: str, Key: str):
+        self._request()
+        try:
+            return {'ETag': self.etags[(Bucket, Key)], 'ContentLength': len(self.objects[(Bucket, Key)])}
+        except KeyError:
+            raise NoSuchKey(Key) from None
+
+    def copy_object(self, Bucket: str, Key: str, CopySource: dict):
+        self._request()
+        self._store(Bucket, Key, self.objects[(CopySource['Bucket'], CopySource['Key'])])
+
+    def list_objects_v2(
+        self, Bucket: str, Prefix: str = '', ContinuationToken: Optional[str] = None, MaxKeys: int = 1000
+    ):
+        self._request()
+        with self._lock:
+            keys = sorted(k for b, k in self.objects if b == Bucket and k.startswith(Prefix))
+            # The continuation token is the offset of the page
+            start = int(ContinuationToken or 0)
+            page = [
+                {'Key': key, 'ETag': self.etags[(Bucket, key)], 'Size': len(self.objects[(Bucket, key)])}
+                for key in keys[start:start + MaxKeys]
+            ]
+        if start + MaxKeys < len(keys):
+            return {'Contents': page, 'IsTruncated': True, 'NextContinuationToken': str(start + MaxKeys)}
+        return {'Contents': page, 'IsTruncated': False}
+
+    def create_multipart_upload(self, Bucket: str, Key: str):
+        self._request()
+        upload_id = str(next(self._upload_ids))
+        self._uploads[upload_id] = {}
+        return {'UploadId': upload_id}
+
+    def upload_part(self, Bucket: str, Key: str, UploadId: str, PartNumber: int, Body):
+        self._request()
+        self._uploads[UploadId][PartNumber] = bytes(Body)
+        return {'ETag': f'"{PartNumber}"'}
+
+    def complete_multipart_upload(self, Bucket: str, Key: str, UploadId: str, MultipartUpload: dict):
+        self._request()
+        parts = self._uploads.pop(UploadId)
+        self._store(Bucket, Key, b''.join(parts[p['PartNumber']] for p in MultipartUpload['Parts']))
+
+    def abort_multipart_upload(self, Bucket: str, Key: str, UploadId: str):
+        self._request()
+        self._uploads.pop(UploadId, None)
+
+
+class LocalS3Context(S3Context):
+    """
+    S3Context over a LocalS3Client. Objects are addressed by s3:// urls only,
+    there is no boto3 resource behind it.
+    """
+    def __init__(self, latency: float = 0.0, throttle: Optional[int] = None, connection: Optional[S3ConnectionConfig] = None):
+        super().__init__(
+            connection or S3ConnectionConfig(region='local', endpoint=None),
+            S3Credentials(None, None, None)
+        )
+        self._client = LocalS3Client(latency, throttle)
+        self._session = self._resource = None
+
+    @property
+    def client(self) -> LocalS3Client:
+        return self._client
+
+    @property
+    def transfer_config(self):
+        return None
+
+    def put(self, url: str, data: bytes):
+        url = S3Url(url)
+        self._client.put_object(Bucket=url.bucket, Key=url.prefix, Body=data)
+
+
+__all__ = [
+    'LocalS3Client',
+    'LocalS3Context'
+]
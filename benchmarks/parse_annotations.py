@@ -0,0 +1,76 @@
+"""
+Benchmark of the annotation model: parse time, memory held per annotation and
+the cost of the `regions`/`data_categories` views builders read in loops.
+
+    python benchmarks/parse_annotations.py --annotations 100000 --regions 3
+"""
+import gc
+import time
+import random
+import argparse
+import tracemalloc
+
+from annotation_exporter.annotations import Annotation
+
+
+def make_annotation(index: int, regions: int) -> dict:
+    result = []
+    for r in range(regions):
+        base = {
+            'id': f'{index}r{r}',
+            'original_width': 4000,
+            'original_height': 3000,
+            'image_rotation': random.choice([0, 90])
+        }
+        if r % 2:
+            points = [[random.uniform(0, 100), random.uniform(0, 100)] for _ in range(6)]
+            result.append({**base, 'type': 'polygon', 'value': {'points': points}})
+        else:
+            box = {k: random.uniform(0, 50) for k in ('x', 'y', 'width', 'height')}
+            result.append({**base, 'type': 'rectangle', 'value': box})
+        result.append({**base, 'type': 'textarea', 'value': {'text': [f'text {r}']}})
+    result.append({
+        'id': f'{index}c',
+        'type': 'choices',
+        'value': {'choices': ['Training']}
+    })
+    return {'id': index, 'updated_at': '2024-01-01T00:00:00Z', 'result': result}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--annotations', type=int, default=100_000)
+    parser.add_argument('--regions', type=int, default=3)
+    parser.add_argument('--view-reads', type=int, default=10)
+    args = parser.parse_args()
+
+    random.seed(0)
+    data = [make_annotation(i, args.regions) for i in range(args.annotations)]
+
+    start = time.perf_counter()
+    annotations = [Annotation.from_json(a) for a in data]
+    parse_time = time.perf_counter() - start
+
+    # tracing slows allocations down a lot, so memory is measured on a separate parse
+    del annotations
+    gc.collect()
+    tracemalloc.start()
+    before, _ = tracemalloc.get_traced_memory()
+    annotations = [Annotation.from_json(a) for a in data]
+    after, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    start = time.perf_counter()
+    for _ in range(args.view_reads):
+        for annotation in annotations:
+            annotation.regions
+            annotation.data_categories
+    view_time = time.perf_counter() - start
+
+    print(f'parse: {parse_time:.2f} s ({args.annotations / parse_time:.0f} annotations/s)')
+    print(f'memory: {(after - before) / args.annotations:.0f} bytes/annotation')
+    print(f'views: {view_time / (args.view_reads * args.annotations) * 1e6:.2f} us/read')
+
+
+if __name__ == '__main__':
+    main()
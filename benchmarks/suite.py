@@ -0,0 +1,202 @@
+"""
+Benchmark suite: times each stage of an export on a synthetic dataset served
+from an in-process S3 stand-in, and writes the results as JSON so runs can be
+compared over time.
+
+Stages:
+    load.*          parsing annotations from an export file and from S3
+    images.*        fetching images from S3, through a cold and a warm disk cache, and decoding them
+    render.<data>   a builder's processing of decoded images, for each of --data
+    export.<data>.* writing that builder's output to a folder and to S3
+    build.<data>    the whole pipeline through `build_dataset`, into a folder
+    build.<a>+<b>   every builder of --data in a single pass, when there's more than one
+
+    python benchmarks/suite.py --tasks 200 --regions 20 --output results.json
+"""
+import os
+import sys
+import json
+import time
+import platform
+import tempfile
+import argparse
+import warnings
+import subprocess
+import contextlib
+from datetime import datetime, timezone
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+from annotation_exporter.annotations import ExportAnnotationLoader, S3AnnotationLoader
+from annotation_exporter.cache import DiskCache
+from annotation_exporter.builder import builder_names, get_builder, MultiBuilder, SourceImage, decode_image
+from annotation_exporter.exporter import FolderExporter, S3Exporter
+from annotation_exporter.s3 import S3ConnectionConfig
+
+from local_s3 import LocalS3Context
+from synthetic import make_dataset, to_s3_annotations
+
+
+class Stages:
+    def __init__(self):
+        self.results = {}
+
+    @contextlib.contextmanager
+    def time(self, name: str, items: int, unit: str):
+        # Builders print progress, which isn't part of the results
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull), warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            start = time.perf_counter()
+            extra = {}
+            yield extra
+            seconds = time.perf_counter() - start
+
+        self.results[name] = {
+            'seconds': seconds,
+            'items': items,
+            'unit': unit,
+            'per_second': items / seconds if seconds else None,
+            **extra
+        }
+        print(f'{name:<28} {seconds:8.3f} s {self.results[name]["per_second"] or 0:12.1f} {unit}/s', file=sys.stderr)
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=Path(__file__).parent, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--tasks', type=int, default=100)
+    parser.add_argument('--annotations', type=int, default=1, help='annotations per task')
+    parser.add_argument('--regions', type=int, default=20, help='regions per annotation')
+    parser.add_argument('--width', type=int, default=1600)
+    parser.add_argument('--height', type=int, default=1200)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--data', default=','.join(builder_names),
+                        help='comma separated builders to benchmark')
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--processes', type=int, default=1)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='simulated S3 request latency in milliseconds')
+    parser.add_argument('--throttle', type=int, default=None,
+                        help='simulated S3 requests in flight above which requests are throttled')
+    parser.add_argument('--output', type=Path, default=None,
+                        help='file to write JSON results to, printed to stdout otherwise')
+    args = parser.parse_args()
+
+    export, images = make_dataset(
+        args.tasks, args.annotations, args.regions, args.width, args.height, seed=args.seed
+    )
+    s3 = LocalS3Context(
+        latency=args.latency / 1000,
+        throttle=args.throttle,
+        # Sized like the CLI sizes it, so throttling has room to show
+        connection=S3ConnectionConfig(region='local', endpoint=None, max_pool_connections=max(10, args.workers * 3))
+    )
+    for url, data in images.items():
+        s3.put(url, data)
+    for key, annotation in to_s3_annotations(export).items():
+        s3.put(f's3://annotations/{key}.json', json.dumps(annotation).encode('utf-8'))
+    annotation_count = args.tasks * args.annotations
+
+    stages = Stages()
+    with tempfile.TemporaryDirectory() as directory:
+        directory = Path(directory)
+        export_path = directory / 'export.json'
+        export_path.write_text(json.dumps(export), encoding='utf-8')
+
+        # 1. Annotations
+        with stages.time('load.export', annotation_count, 'annotations'):
+            tasks = list(ExportAnnotationLoader().get_tasks(export_path))
+        with stages.time('load.export_stream', annotation_count, 'annotations'):
+            list(ExportAnnotationLoader(stream=True).get_tasks(export_path))
+        with stages.time('load.s3', annotation_count, 'annotations'):
+            list(S3AnnotationLoader(s3, workers=args.workers).get_tasks('s3://annotations/'))
+
+        # 2. Images
+        with stages.time('images.fetch', len(tasks), 'images') as extra:
+            fetched = [s3.download_buffer(task.image_url) for task in tasks]
+            extra['bytes'] = sum(len(data) for data in fetched)
+        s3.cache = DiskCache(directory / 'cache', max_size=2 * extra['bytes'])
+        # Cold fills the cache, warm revalidates every entry with a conditional GET
+        for stage in ('images.cache_cold', 'images.cache_warm'):
+            with stages.time(stage, len(tasks), 'images'):
+                for task in tasks:
+                    s3.download_buffer(task.image_url)
+        s3.cache = None
+        with stages.time('images.decode', len(tasks), 'images'):
+            decoded = [decode_image(data) for data in fetched]
+
+        # 3. Builders
+        names = args.data.split(',')
+        for name in names:
+            builder_type = get_builder(name)
+
+            builder = builder_type(s3, workers=args.workers)
+            with stages.time(f'render.{name}', len(tasks), 'tasks'):
+                outputs = [
+                    builder.render_task(i, task, SourceImage(data, array))
+                    for i, (task, data, array) in enumerate(zip(tasks, fetched, decoded))
+                ]
+            files = [file for output in outputs for file in output.files]
+            size = sum(len(data) for _, data in files)
+
+            exporters = {
+                'folder': lambda: FolderExporter(directory / 'folder' / name),
+                's3': lambda: S3Exporter(s3, f's3://exports/{name}', workers=args.workers)
+            }
+            for target, make_exporter in exporters.items():
+                with stages.time(f'export.{name}.{target}', len(files), 'files') as extra:
+                    exporter = make_exporter()
+                    for path, data in files:
+                        exporter.export_bytes(data, path)
+                    exporter.close()
+                    extra['bytes'] = size
+
+            builder = builder_type(s3, workers=args.workers, processes=args.processes)
+            with stages.time(f'build.{name}', len(tasks), 'tasks'):
+                builder.build_dataset(tasks, [FolderExporter(directory / 'build' / name)])
+
+        if len(names) > 1:
+            targets = [[FolderExporter(directory / 'multi' / name)] for name in names]
+            builder = MultiBuilder(
+                s3, [get_builder(name)(s3) for name in names], targets,
+                workers=args.workers, processes=args.processes
+            )
+            with stages.time(f'build.{builder.name}', len(tasks), 'tasks'):
+                builder.build_dataset(tasks, [exporter for exporters in targets for exporter in exporters])
+
+    results = {
+        'timestamp': datetime.now(timezone.utc).isoformat(),
+        'commit': git_commit(),
+        'environment': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'numpy': np.__version__,
+            'opencv': cv2.__version__
+        },
+        'config': {k: str(v) if isinstance(v, Path) else v for k, v in vars(args).items()},
+        's3_requests': s3.client.requests,
+        's3_throttled': s3.client.throttled,
+        's3_concurrency_limit': s3.scheduler.limit,
+        'stages': stages.results
+    }
+    text = json.dumps(results, indent=2)
+    if args.output is not None:
+        args.output.write_text(text, encoding='utf-8')
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+"""
+Synthetic Label Studio data: page-like JPEG images with dark text lines, and
+export tasks whose regions outline those lines. Generation is seeded, so the
+same arguments always give the same dataset.
+"""
+import random
+from typing import Dict, List, Tuple
+
+import cv2
+import numpy as np
+
+
+ROTATIONS = [0, 0, 0, 90, 180, 270]
+
+
+def make_image(rng: random.Random, width: int, height: int, boxes: List[Tuple[float, float, float, float]]) -> bytes:
+    image = np.full((height, width, 3), 235, dtype=np.uint8)
+    # Paper-like noise, so JPEG sizes are closer to real scans
+    noise = np.random.default_rng(rng.randrange(1 << 32)).integers(0, 20, (height, width, 1), dtype=np.uint8)
+    image -= noise
+
+    for x, y, w, h in boxes:
+        x1, y1 = int(x / 100 * width), int(y / 100 * height)
+        y2 = int((y + h) / 100 * height)
+        cv2.putText(
+            image, 'synthetic text', (x1, y2),
+            cv2.FONT_HERSHEY_SIMPLEX, max((y2 - y1) / 30, 0.3), (30, 30, 30), 2
+        )
+
+    _, buffer = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, 90])
+    return buffer.tobytes()
+
+
+def make_region(rng: random.Random, region_id: str, box, width: int, height: int, rotation: int, polygon: bool) -> List[dict]:
+    x, y, w, h = box
+    base = {
+        'id': region_id,
+        'original_width': width,
+        'original_height': height,
+        'image_rotation': rotation
+    }
+    if polygon:
+        points = [[x, y], [x + w, y + rng.uniform(0, 1)], [x + w, y + h], [x + rng.uniform(0, 1), y + h]]
+        shape = {**base, 'type': 'polygon', 'value': {'points': points}}
+    else:
+        shape = {**base, 'type': 'rectangle', 'value': {'x': x, 'y': y, 'width': w, 'height': h}}
+    text = {**base, 'type': 'textarea', 'value': {'text': [f'text of {region_id}']}}
+    return [shape, text]
+
+
+def make_dataset(
+    tasks: int,
+    annotations: int = 1,
+    regions: int = 10,
+    width: int = 1600,
+    height: int = 1200,
+    bucket: str = 'images',
+    seed: int = 0
+) -> Tuple[List[dict], Dict[str, bytes]]:
+    """
+    Returns a Label Studio export and the images it refers to, keyed by s3:// url.
+    """
+    rng = random.Random(seed)
+    export, images = [], {}
+
+    for t in range(tasks):
+        # Text lines stacked down the page, so regions don't overlap
+        line_height = 90 / regions
+        boxes = [
+            (rng.uniform(2, 20), 5 + r * line_height, rng.uniform(40, 75), line_height * 0.7)
+            for r in range(regions)
+        ]
+        url = f's3://{bucket}/{t:06d}.jpg'
+        images[url] = make_image(rng, width, height, boxes)
+
+        task_annotations = []
+        for a in range(annotations):
+            rotation = rng.choice(ROTATIONS)
+            result = []
+            for r, box in enumerate(boxes):
+                result.extend(make_region(rng, f't{t}a{a}r{r}', box, width, height, rotation, polygon=r % 2 == 1))
+            result.append({
+                'id': f't{t}a{a}c',
+                'type': 'choices',
+                'value': {'choices': ['Training' if rng.random() < 0.8 else 'Validation']}
+            })
+            task_annotations.append({
+                'id': t * annotations + a,
+                'updated_at': '2024-01-01T00:00:00.000000Z',
+                'result': result
+            })
+        export.append({'id': t, 'data': {'ocr': url}, 'annotations': task_annotations})
+    return export, images
+
+
+def to_s3_annotations(export: List[dict]) -> Dict[str, dict]:
+    """
+    Splits an export into per-annotation objects, as Label Studio's S3 target storage writes them.
+    """
+    objects = {}
+    for task in export:
+        for annotation in task['annotations']:
+            objects[str(annotation['id'])] = {**annotation, 'task': {'id': task['id'], 'data': task['data']}}
+    return objects
+
+
+__all__ = [
+    'make_dataset',
+    'to_s3_annotations'
+]